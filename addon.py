@@ -1,23 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import time
+start_time = time.perf_counter()
+
 import sys
 from urllib.parse import parse_qsl
 import json
 
 from resources.lib.kodihelper import KodiHelper
+import_time = time.perf_counter()
 
 base_url = sys.argv[0]
 handle = int(sys.argv[1])
 helper = KodiHelper(base_url, handle)
+init_time = time.perf_counter()
 
-def list_main_pages():
-    pages = helper.c.get_page(page_type='/tree')
+def list_main_pages(pages):
 
     for page in pages:
         params = {
             'action': 'list_categories_or_videos',
             'main_path': page['path'],
-            'subs': json.dumps(page['subs'])
+            'subs': helper.c.store_payload(page['subs'])
         }
 
         art = {
@@ -29,9 +33,10 @@ def list_main_pages():
     helper.add_item(helper.language(30011), params={'action': 'list_page', 'dataurl': helper.c.config['dynamicMbApiUrl'] + '/favorites'})
     helper.add_item(helper.language(30007), params={'action': 'search'})
     helper.eod()
+    helper.revalidate_listing()
 
 def list_categories_or_videos(main_path, subs):
-    subc = json.loads(subs)
+    subc = subs
     # If there is more than one subcategory use list_categories
     if len(subc) > 1:
         list_categories(subs=subs)
@@ -42,18 +47,18 @@ def list_categories_or_videos(main_path, subs):
             if subcat['type'] == 'curated':
                 list_featured_categories(dataurl=subcat['dataUrl'])
             else:
-                list_page(dataurl=subcat['dataUrl'])
+                list_page(dataurl=subcat['dataUrl'], offset=0)
         # If there is no subcategories use main path
         else:
             category = helper.c.get_path_dataurl(main_path)
             if category['type'] == 'curated':
                 list_featured_categories(dataurl=category['dataUrl'])
             else:
-                list_page(dataurl=category['dataUrl'])
+                list_page(dataurl=category['dataUrl'], offset=0)
 
 #List genre categories (documentaries, horror etc)
 def list_categories(subs):
-    for sub in json.loads(subs):
+    for sub in subs:
         title = sub['title']
 
         params = {
@@ -67,104 +72,116 @@ def list_categories(subs):
 
 # Poiminnat
 def list_featured_categories(dataurl):
-    categories = helper.c.parse_page(dataurl=dataurl)
+    categories = helper.c.parse_page(dataurl=dataurl, stale_ok=True)
+    targets = []
     for i in categories:
         if i.get('title'):
             if 'items' in i.keys():
                 # Use larger list of category contents if available
                 if 'target' in i.keys() and i['component'] == 'default':
-                    title = i['title'].encode('utf-8')
+                    title = i['title']
                     params = {
                         'action': 'list_page_target',
                         'target': i['target']['path']
                     }
+                    targets.append(i['target']['path'])
                 else:
-                    title = i['title'].encode('utf-8')
+                    title = i['title']
                     params = {
                         'action': 'list_page_with_page_data',
-                        'page_data': json.dumps(i['items'])
+                        'page_data': helper.c.store_payload(i['items'])
                     }
                 helper.add_item(title, params)
 
             # Lajit in sport category
             if 'targets' in i.keys():
-                title = i['title'].encode('utf-8')
+                title = i['title']
                 params = {
                     'action': 'list_category_links',
-                    'targets': json.dumps(i['targets'])
+                    'targets': helper.c.store_payload(i['targets'])
                 }
                 helper.add_item(title, params)
     helper.eod()
+    helper.revalidate_listing()
+
+    # Resolve the sections of the page in one parallel burst after the listing has been handed to Kodi
+    if targets:
+        helper.c.prefetch_targets(targets)
 
 #List sport category Lajit content (Formula 1, golf etc)
 def list_category_links(targets):
-    targets = json.loads(targets)
-
     for target in targets:
-        title = target['title'].encode('utf-8')
-        url = helper.c.config['dynamicMbApiUrl'] + '/{0}/assets?size=250'.format(target['path'])
+        title = target['title']
+        url = helper.c.config['dynamicMbApiUrl'] + '/{0}/assets'.format(target['path'])
         params = {
             'action': 'list_page',
-            'dataurl': url
+            'dataurl': url,
+            'offset': 0
         }
         helper.add_item(title, params)
 
     helper.eod()
 
-def list_page(dataurl=None, page_data=None, target=None, search_query=None):
+def list_page(dataurl=None, page_data=None, target=None, search_query=None, offset=None):
+    # Asset lists, targets and search are fetched one page at a time when offset is given
+    next_offset = None
     if dataurl:
-        page_dict = helper.c.parse_page(dataurl=dataurl)
-    elif page_data:
-        page_dict = json.loads(page_data)
+        if offset is None:
+            page_dict = helper.c.parse_page(dataurl=dataurl, stale_ok=True)
+        else:
+            page_dict, next_offset = helper.c.get_assets_page(dataurl, offset, stale_ok=True)
+    elif page_data is not None:
+        page_dict = page_data
     elif target:
-        page_dict = helper.c.get_target_path(target)
+        page_dict, next_offset = helper.c.get_target_path(target, offset or 0, stale_ok=True)
     elif search_query:
-        page_dict = helper.c.get_search_data(search_query)
+        page_dict, next_offset = helper.c.get_search_data(search_query, offset or 0)
 
     # if not page_dict:
     #    return False
     # helper.log(page_dict)
 
-    for i in page_dict:
-        # Favorites and featured
-        # List movies from poiminnat and favorites and sport(Live formula, live sport)
-        if i.get('asset'):
-            if i['asset']['type'] == 'sport':
-                list_event(i['asset'])
-            else:
-                list_movie(i['asset'])
-        # List tvshows when coming from poiminnat -> sub category and favorites
-        if i.get('category'):
-            list_tvshow(i['category'])
-
-        # Regular
-        elif i.get('type') == 'movie':
-            list_movie(i)
-        elif i.get('type') == 'series':
-            # If seasons in data
-            if i.get('groups'):
-                list_tvshow(i)
-            # If season id in data = list_episode
-            elif i.get('type') == 'episode':
-                list_episode(i)
-            else:
-                list_season(i)
-
-        # F1 and sport categories
-        elif i.get('type') == 'sport':
-            # List folders
-            if 'groups' in i.keys():
-                list_season(i)
-            else:
-                list_event(i)
-
-        elif i.get('channel'):
-            list_channel(i)
+    assets = helper.c.parse_assets(page_dict)
+    season_urls = list_assets(assets)
 
-        elif i.get('type') == 'episode':
-            list_episode(i)
+    if next_offset is not None:
+        if dataurl:
+            params = {'action': 'list_page', 'dataurl': dataurl}
+        elif target:
+            params = {'action': 'list_page_target', 'target': target}
+        else:
+            params = {'action': 'search', 'query': search_query}
+        params['offset'] = next_offset
+        helper.add_item(helper.language(30013), params)
 
     helper.eod()
+    helper.revalidate_listing()
+
+    # Warm the cache for the season folders and streams after the listing has been handed to Kodi
+    helper.c.index_assets(assets)
+    if season_urls and helper.settings.prefetch_seasons:
+        helper.c.prefetch_assets(season_urls)
+    helper.prefetch_streams()
+
+def list_assets(assets):
+    """Add directory items for the assets and return the URLs of the season folders among them."""
+    season_urls = []
+    # Events are compared against one clock reading per listing
+    now = time.time()
+    for asset in assets:
+        if asset.kind == 'movie':
+            list_movie(asset)
+        elif asset.kind == 'episode':
+            list_episode(asset)
+        elif asset.kind == 'event':
+            list_event(asset, now)
+        elif asset.kind == 'tvshow':
+            list_tvshow(asset)
+        elif asset.kind == 'season':
+            season_urls.append(list_season(asset))
+        elif asset.kind == 'channel':
+            list_channel(asset, now)
+    return season_urls
 
 def coloring(text, meaning):
     """Return the text wrapped in appropriate color markup."""
@@ -177,111 +194,77 @@ def coloring(text, meaning):
 
     return colored_text
 
-def list_tvshow(tvshow):
-    # If program name is number for example 112
-    if isinstance(tvshow['title'], int):
-        title = str(tvshow['title'])
-    else:
-        title = tvshow['title'].encode('utf-8')
+def get_art(asset):
+    return {
+        'fanart': asset.fanart or asset.landscape,
+        'thumb': asset.landscape,
+        'cover': asset.landscape,
+        'poster': asset.portrait
+    }
 
+def list_tvshow(tvshow):
     params = {
         'action': 'list_page_with_page_data',
-        'page_data': json.dumps(tvshow['groups'])
+        'page_data': helper.c.store_payload(tvshow.groups)
     }
 
     info = {
         'mediatype': 'tvshow',
-        'title': title,
-        'tvshowtitle': title,
-        'plot': tvshow.get('description')
+        'title': tvshow.title,
+        'tvshowtitle': tvshow.title,
+        'plot': tvshow.description
     }
 
-    landscape_image = tvshow['images']['landscape'][-1]['url'] if tvshow['images'].get('landscape') else None
-    poster_image = tvshow['images']['portrait'][-1]['url'] if tvshow['images'].get('portrait') else None
-
-    art = {
-        'fanart': landscape_image,
-        'thumb': landscape_image,
-        'cover': landscape_image,
-        'poster': poster_image
-        }
-
-    helper.add_item(title, params, info=info, art=art)
+    helper.add_item(tvshow.title, params, info=info, art=get_art(tvshow))
 
 def list_season(season):
-    title = season['title'].encode('utf-8')
-    url = helper.c.config['dynamicMbApiUrl'] + '/category/{0}/assets?size=250'.format(season['id'])
+    url = helper.c.config['dynamicMbApiUrl'] + '/category/{0}/assets'.format(season.id)
     params = {
         'action': 'list_page',
-        'dataurl': url
+        'dataurl': url,
+        'offset': 0
     }
 
     info = {
         'mediatype': 'season',
-        'plot': title
+        'plot': season.title
     }
 
-    landscape_image = season['images']['landscape'][-1]['url'] if season['images'].get('landscape') else None
-    poster_image = season['images']['portrait'][-1]['url'] if season['images'].get('portrait') else None
-
-    art = {
-        'fanart': landscape_image,
-        'thumb': landscape_image,
-        'cover': landscape_image,
-        'poster': poster_image
-    }
+    helper.add_item(season.title, params, info=info, art=get_art(season))
 
-    helper.add_item(title, params, info=info, art=art)
+    return url
 
 def list_episode(i):
     params = {
         'action': 'play',
-        'video_id': i['id']
+        'video_id': i.id
     }
 
-    landscape_image = i['images']['landscape'][-1]['url'] if i['images'].get('landscape') else None
-    poster_image = i['images']['portrait'][-1]['url'] if i['images'].get('portrait') else None
-
-    if i.get('actors'):
-        if ', ' in i.get('actors'):
-            actors = i.get('actors').split(', ')
-        else:
-            actors = [i['actors']]
-    else:
-        actors = []
-
     video_info = {
         'mediatype': 'episode',
-        'title': i.get('subtitle'),
-        'tvshowtitle': i.get('title'),
-        'season': i.get('season'),
-        'episode': i.get('episode'),
-        'plot': i.get('description'),
-        'cast': actors,
-        'director': i.get('director'),
-        'duration': i.get('duration'),
-        'genre': ', '.join(i['genres']) if i.get('genres') else None
+        'title': i.subtitle,
+        'tvshowtitle': i.title,
+        'season': i.season,
+        'episode': i.episode,
+        'plot': i.description,
+        'cast': i.cast,
+        'director': i.director,
+        'duration': i.duration,
+        'genre': i.genre
     }
 
-    art = {
-        'fanart': landscape_image,
-        'thumb': landscape_image,
-        'cover': landscape_image,
-        'poster': poster_image
-    }
+    helper.add_item(i.subtitle, params=params, info=video_info, art=get_art(i), content='episodes', playable=True)
 
-    helper.add_item(i.get('subtitle'), params=params, info=video_info, art=art, content='episodes', playable=True)
-
-def list_event(i):
-    if helper.c.parse_datetime(event_date=i['liveBroadcastTime']) > helper.c.get_current_time(utc=True):
+def list_event(i, now):
+    if i.broadcast_time > now:
         event_status = 'upcoming'
         params = {'action': 'noop'}
         playable = False
     else:
-        if helper.get_setting('50fps') and i.get('50fps') and i.get('live'):
-            video_id = i['50fps']
+        if helper.settings.use_50fps and i.id_50fps and i.live:
+            video_id = i.id_50fps
         else:
-            video_id = i['id']
+            video_id = i.id
 
         event_status = 'live'
         params = {
@@ -290,106 +273,131 @@ def list_event(i):
         }
         playable = True
 
-    list_title = '[B]{0}:[/B] {1}'.format(coloring(helper.c.aslocaltimestr(i['liveBroadcastTime']), event_status), i['subtitle'].encode('utf-8'))
-
-    landscape_image = i['images']['landscape'][-1]['url'] if i['images'].get('landscape') else None
-    poster_image = i['images']['portrait'][-1]['url'] if i['images'].get('portrait') else None
+    list_title = '[B]{0}:[/B] {1}'.format(coloring(helper.c.format_local_time(i.broadcast_time), event_status), i.subtitle)
 
     video_info = {
         'mediatype': 'video',
-        'title': i.get('subtitle'),
-        'tvshowtitle': i.get('title'),
-        'plot': i.get('description'),
-        'duration': i.get('duration')
-    }
-
-    art = {
-        'fanart': landscape_image,
-        'thumb': landscape_image,
-        'cover': landscape_image,
-        'poster': poster_image
+        'title': i.subtitle,
+        'tvshowtitle': i.title,
+        'plot': i.description,
+        'duration': i.duration
     }
 
-    helper.add_item(list_title, params=params, info=video_info, art=art, content='videos', playable=playable)
+    helper.add_item(list_title, params=params, info=video_info, art=get_art(i), content='videos', playable=playable)
 
-def list_channel(i):
+def list_channel(i, now):
     params = {
         'action': 'play',
-        'video_id': i['channel']['id']
+        'video_id': i.id
     }
 
+    program, upcoming = helper.c.get_now_next(i.id, now)
+    if not program:
+        program = i.programs[0]
     program_info = {
         'mediatype': 'video',
-        'title': i['epg'][0]['title'],
-        'plot': i['epg'][0].get('description')
+        'title': program.title,
+        'plot': program.description
     }
-
-    landscape_image = i['epg'][0]['images']['landscape'][-1]['url'] if i['epg'][0].get('images') else None
+    if upcoming:
+        program_info['plot'] = '{0}\n\n[B]{1} {2}:[/B] {3}'.format(
+            program.description or '', helper.language(30021),
+            helper.c.format_local_time(upcoming.broadcast_time), upcoming.title)
 
     channel_art = {
-        'fanart': landscape_image,
-        'thumb': landscape_image,
-        'cover': landscape_image,
-        'icon': i['channel']['images']['landscape'][-1]['url'] if i['channel']['images'].get('landscape') else None
+        'fanart': program.fanart or program.landscape,
+        'thumb': program.landscape,
+        'cover': program.landscape,
+        'icon': i.landscape
     }
 
-    channel_colored = coloring(i['channel']['title'], 'live').encode('utf-8')
-    time_colored = coloring(helper.c.parse_datetime(epg_date=i['epg'][0]['epgLiveBroadcastTime']).strftime('%d.%m.%Y %H:%M'), 'live')
-    program_title = i['epg'][0]['title'].encode('utf-8')
-    list_title = '[B]{0} {1}[/B]: {2}'.format(channel_colored, time_colored, program_title)
+    channel_colored = coloring(i.title, 'live')
+    time_colored = coloring(helper.c.format_local_time(program.broadcast_time), 'live')
+    list_title = '[B]{0} {1}[/B]: {2}'.format(channel_colored, time_colored, program.title)
 
     helper.add_item(list_title, params=params, info=program_info, art=channel_art, content='episodes', playable=True)
 
 def list_movie(i):
     params = {
         'action': 'play',
-        'video_id': i['id']
+        'video_id': i.id
     }
 
-    landscape_image = i['images']['landscape'][-1]['url'] if i['images'].get('landscape') else None
-    poster_image = i['images']['portrait'][-1]['url'] if i['images'].get('portrait') else None
-
-    if i.get('actors'):
-        if ', ' in i.get('actors'):
-            actors = i.get('actors').split(', ')
-        else:
-            actors = [i['actors']]
-    else:
-        actors = []
-
-    title = i.get('title')
-    content = 'movies'
     video_info = {
         'mediatype': 'movie',
-        'title': i.get('title'),
-        'plot': i.get('description'),
-        'cast': actors,
-        'country': i.get('productionCountries'),
-        'mpaa': i.get('parentalRating'),
-        'imdbnumber': i.get('imdbId') if i.get('imdbId') else None,
-        'director': i.get('director'),
-        'duration': i.get('duration'),
-        'year': i.get('productionYear'),
-        'genre': ', '.join(i['genres']) if i.get('genres') else None
+        'title': i.title,
+        'plot': i.description,
+        'cast': i.cast,
+        'country': i.country,
+        'mpaa': i.mpaa,
+        'imdbnumber': i.imdb,
+        'director': i.director,
+        'duration': i.duration,
+        'year': i.year,
+        'genre': i.genre
     }
 
-    art = {
-        'fanart': landscape_image,
-        'thumb': landscape_image,
-        'cover': landscape_image,
-        'poster': poster_image
-    }
-
-    helper.add_item(title, params=params, info=video_info, art=art, content=content, playable=True)
+    helper.add_item(i.title, params=params, info=video_info, art=get_art(i), content='movies', playable=True)
 
 def search():
     search_query = helper.get_user_input(helper.language(30007))
     if search_query:
-        list_page(search_query=search_query)
+        list_search(search_query)
     else:
         helper.log('No search query provided.')
         return False
 
+def list_search(search_query):
+    """List matches from the local search index at once, then ask the API and
+    update the listing with the results the local ones did not cover."""
+    assets = helper.c.search_local(search_query)
+    if not assets:
+        list_page(search_query=search_query, offset=0)
+        return
+
+    list_assets(assets)
+    helper.eod()
+
+    try:
+        remote_items, next_offset = helper.c.get_search_data(search_query)
+    except (IOError, ValueError, KeyError, helper.c.CMoreError) as error:
+        # The local matches stay listed when the API cannot be reached
+        helper.log('Remote search failed: %s' % error)
+        return
+    remote_assets = helper.c.parse_assets(remote_items)
+    helper.c.index_assets(remote_assets)
+    if len(helper.c.merge_assets(assets, remote_assets)) > len(assets) or next_offset is not None:
+        # Replace rather than refresh the listing, a refresh of the search action would ask for the query again
+        helper.update_listing({'action': 'search', 'query': search_query, 'merge': 'true'})
+
+def list_search_results(search_query):
+    """List the local matches followed by the first page of remote results they do not
+    already cover. The remote page was just fetched by list_search and comes from the cache."""
+    remote_items, next_offset = helper.c.get_search_data(search_query)
+    assets = helper.c.merge_assets(helper.c.search_local(search_query), helper.c.parse_assets(remote_items))
+    list_assets(assets)
+    if next_offset is not None:
+        helper.add_item(helper.language(30013), {'action': 'search', 'query': search_query, 'offset': next_offset})
+    helper.eod()
+
+def list_expired():
+    """Tell that the payload of the listing has been pruned, the URL came from favourites or history."""
+    helper.dialog('ok', helper.language(30025), helper.language(30026))
+    helper.eod(succeeded=False)
+
+def get_payload(value):
+    """Return the payload stored under the key value in a plugin URL, None if it has expired."""
+    # URLs saved before payloads were moved out of them still carry the JSON itself
+    if value.startswith('[') or value.startswith('{'):
+        return json.loads(value)
+    return helper.c.load_payload(value)
+
+def get_offset(params):
+    """Return the paging offset in params or None if the listing is not paged."""
+    if 'offset' in params:
+        return int(params['offset'])
+    return None
+
 def router(paramstring):
     """
     Router function that calls other functions
@@ -405,38 +413,66 @@ def router(paramstring):
     if 'setting' in params:
         if params['setting'] == 'reset_credentials':
             helper.reset_credentials()
+    elif params.get('action') == 'perf_report':
+        helper.show_perf_report()
     elif 'action' in params:
         if helper.check_for_prerequisites():
             if params['action'] == 'list_categories_or_videos':
-                list_categories_or_videos(main_path=params['main_path'], subs=params['subs'])
+                subs = get_payload(params['subs'])
+                if subs is None:
+                    # The subcategories are also in the menu, which is usually still cached
+                    subs = helper.c.get_main_page_subs(params['main_path'])
+                if subs is None:
+                    list_expired()
+                else:
+                    list_categories_or_videos(main_path=params['main_path'], subs=subs)
             elif params['action'] == 'list_category_content':
                 subcat = helper.c.get_path_dataurl(params['path'])
                 # Poiminnat
                 if subcat['type'] == 'curated':
                     list_featured_categories(dataurl=subcat['dataUrl'])
                 else:
-                    list_page(dataurl=subcat['dataUrl'])
+                    list_page(dataurl=subcat['dataUrl'], offset=0)
             elif params['action'] == 'list_page':
-                list_page(dataurl=params['dataurl'])
+                list_page(dataurl=params['dataurl'], offset=get_offset(params))
             elif params['action'] == 'list_page_target':
                 #list_page(dataurl=helper.c.get_target_path(params['target']))
-                list_page(target=params['target'])
+                list_page(target=params['target'], offset=get_offset(params))
             elif params['action'] == 'list_page_with_page_data':
-                list_page(page_data=params['page_data'])
+                page_data = get_payload(params['page_data'])
+                if page_data is None:
+                    list_expired()
+                else:
+                    list_page(page_data=page_data)
             elif params['action'] == 'list_category_links':
-                list_category_links(targets=params['targets'])
+                targets = get_payload(params['targets'])
+                if targets is None:
+                    list_expired()
+                else:
+                    list_category_links(targets=targets)
             elif params['action'] == 'play':
                 # Play a video from a provided URL.
                 helper.play_item(params['video_id'])
             elif params['action'] == 'search':
-                search()
+                if 'query' in params:
+                    # Next page of remote results, the listing updated with them or a new search
+                    if get_offset(params):
+                        list_page(search_query=params['query'], offset=get_offset(params))
+                    elif params.get('merge') == 'true':
+                        list_search_results(params['query'])
+                    else:
+                        list_search(params['query'])
+                else:
+                    search()
     else:
         if helper.check_for_prerequisites():
             try:
-                helper.login_process() # Have to trigger login process every time to get new cookie
+                # Fetch the menu on the thread pool while the session is checked
+                main_pages = helper.c.pool.submit(helper.c.fetch_main_pages, True, True)
+                helper.login_process() # Only logs in when the session cookie is missing or expired
                 # If the plugin is called from Kodi UI without any parameters,
                 # display the list of video categories
-                list_main_pages()
+                list_main_pages(main_pages.result())
             except helper.c.CMoreError as error:
                 if error.value == 'AUTHENTICATION_FAILED':
                     helper.dialog('ok', helper.language(30006), helper.language(30012))
@@ -444,4 +480,9 @@ def router(paramstring):
 if __name__ == '__main__':
     # Call the router function and pass the plugin call parameters to it.
     # We use string slicing to trim the leading '?' from the plugin call paramstring
-    router(sys.argv[2][1:])
+    paramstring = sys.argv[2][1:]
+    try:
+        router(paramstring)
+    finally:
+        helper.record_route(dict(parse_qsl(paramstring)).get('action', 'root'), start_time, import_time, init_time)
+        helper.c.close()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic C More API fixtures shaped and sized like the live responses
+"""
+import json
+import time
+import random
+import datetime
+
+GENRES = ['Draama', 'Komedia', 'Jännitys', 'Dokumentti', 'Kauhu', 'Lapset', 'Urheilu', 'Rikos']
+WORDS = ['Helsinki', 'yö', 'kesä', 'Tampere', 'salaisuus', 'perhe', 'Åland', 'ystävät', 'talvi', 'meri',
+         'kaupunki', 'rakkaus', 'pimeä', 'tarina', 'Göteborg', 'sydän', 'tähti', 'metsä']
+NAMES = ['Aino Virtanen', 'Mikko Korhonen', 'Sofia Nieminen', 'Jukka Mäkinen', 'Elsa Lindqvist',
+         'Oskar Björk', 'Laura Heikkinen', 'Ville Koskinen']
+
+MAIN_PAGE_COUNT = 8
+SUBS_PER_PAGE = 6
+PATH_COUNT = 2500
+CATEGORY_SIZE = 250
+SEARCH_SIZE = 100
+CHANNEL_COUNT = 12
+SEASON_ID_BASE = 10000000
+
+
+def images(rng, asset_id):
+    """Image renditions from the smallest to the largest like the API returns them."""
+    renditions = {}
+    for orientation, ratio in (('landscape', 9.0 / 16), ('portrait', 3.0 / 2)):
+        renditions[orientation] = [
+            {
+                'url': 'https://images.example/{0}/{1}/{2}.jpg'.format(orientation, asset_id, width),
+                'width': width,
+                'height': int(width * ratio)
+            } for width in (320, 640, 1280, 1920)
+        ]
+    return renditions
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def broadcast_time(rng):
+    start = datetime.datetime(2026, 10, 18, 12, 0) + datetime.timedelta(hours=rng.randint(-48, 96))
+    return start.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def asset(rng, asset_id, asset_type):
+    item = {
+        'id': str(asset_id),
+        'type': asset_type,
+        'title': sentence(rng, 2),
+        'subtitle': sentence(rng, 3),
+        'description': sentence(rng, 40),
+        'duration': rng.randint(1200, 7200),
+        'genres': rng.sample(GENRES, 2),
+        'actors': ', '.join(rng.sample(NAMES, 3)),
+        'director': rng.choice(NAMES),
+        'productionYear': rng.randint(1990, 2026),
+        'productionCountries': ['Suomi'],
+        'parentalRating': rng.choice(['S', '7', '12', '16']),
+        'imdbId': 'tt%07d' % asset_id,
+        'images': images(rng, asset_id)
+    }
+    if asset_type == 'episode':
+        item['season'] = rng.randint(1, 5)
+        item['episode'] = rng.randint(1, 12)
+    elif asset_type == 'sport':
+        item['liveBroadcastTime'] = broadcast_time(rng)
+        item['live'] = True
+        item['50fps'] = str(asset_id + 500000)
+    return item
+
+
+def series(rng, category_id, seasons=4):
+    return {
+        'id': str(category_id),
+        'type': 'series',
+        'title': sentence(rng, 2),
+        'description': sentence(rng, 30),
+        'images': images(rng, category_id),
+        'groups': [
+            {
+                'id': str(SEASON_ID_BASE + category_id * 10 + season),
+                'type': 'series',
+                'title': 'Kausi %d' % season,
+                'images': images(rng, category_id * 10 + season)
+            } for season in range(1, seasons + 1)
+        ]
+    }
+
+
+def category_assets(category_id):
+    """Asset list of a category, a mix of series, episodes and movies."""
+    rng = random.Random(category_id)
+    result = []
+    for n in range(CATEGORY_SIZE):
+        asset_id = category_id * 1000 + n
+        if n % 5 == 0:
+            result.append(series(rng, asset_id))
+        elif n % 5 == 1:
+            result.append(asset(rng, asset_id, 'episode'))
+        else:
+            result.append(asset(rng, asset_id, 'movie'))
+    return {'result': result}
+
+
+def season_assets(season_id):
+    rng = random.Random(season_id)
+    return {'result': [asset(rng, season_id * 100 + e, 'episode') for e in range(12)]}
+
+
+def curated_page(page_id):
+    """Curated page with item carousels, links to larger lists and sport links."""
+    rng = random.Random(page_id)
+    sections = []
+    for section in range(10):
+        items = [{'asset': asset(rng, page_id * 100 + section * 20 + n, 'movie')} for n in range(20)]
+        sections.append({
+            'title': sentence(rng, 2),
+            'component': 'default',
+            'items': items,
+            'target': {'path': '/polku/%d?sort=popular' % (section * 2 + 1)}
+        })
+    sections.append({
+        'title': 'Lajit',
+        'targets': [{'title': sentence(rng, 1), 'path': 'category/%d' % n} for n in range(20)]
+    })
+    return sections
+
+
+def build(base_url):
+    """Return a dict of request path to response object for the fixed endpoints of a mock API at base_url."""
+    rng = random.Random(90)
+    static_url = base_url + '/static'
+    dynamic_url = base_url + '/dynamic'
+    vimond_url = base_url + '/vimond'
+    routes = {}
+
+    routes['/config'] = {
+        'staticMbApiUrl': static_url,
+        'dynamicMbApiUrl': dynamic_url,
+        'vimondApiUrl': vimond_url
+    }
+
+    paths = []
+    for path_id in range(PATH_COUNT):
+        curated = path_id % 10 == 0
+        paths.append({
+            'visibleUrl': '/sivu/%d' % path_id,
+            'path': '/polku/%d' % path_id,
+            'type': 'curated' if curated else 'page',
+            'dataUrl': dynamic_url + ('/page/%d' if curated else '/category/%d/assets') % path_id,
+            'title': sentence(rng, 2)
+        })
+    routes['/static/paths'] = paths
+
+    tree = []
+    for page_id in range(MAIN_PAGE_COUNT):
+        subs = [{'title': sentence(rng, 1), 'path': '/sivu/%d' % (page_id * SUBS_PER_PAGE + sub_id)}
+                for sub_id in range(SUBS_PER_PAGE)]
+        tree.append({
+            'title': sentence(rng, 1),
+            'path': '/sivu/%d' % page_id,
+            'image': 'https://images.example/tree/%d.jpg' % page_id,
+            'subs': subs
+        })
+    routes['/static/tree'] = tree
+
+    routes['/dynamic/sport'] = {
+        'category': {
+            'groups': [asset(rng, 700000 + n, 'sport') for n in range(CATEGORY_SIZE)]
+        }
+    }
+
+    routes['/dynamic/favorites'] = [{'asset': asset(rng, 800000 + n, 'movie')} for n in range(30)]
+
+    now = datetime.datetime(2026, 10, 18, 12, 0)
+    channels = []
+    for channel_id in range(CHANNEL_COUNT):
+        epg = []
+        for slot in range(24):
+            start = now + datetime.timedelta(hours=slot - 1)
+            epg.append({
+                'title': sentence(rng, 2),
+                'description': sentence(rng, 20),
+                'epgLiveBroadcastTime': start.strftime('%Y-%m-%dT%H:%M:%S') + '+03:00',
+                'images': images(rng, 900000 + channel_id * 100 + slot)
+            })
+        channels.append({
+            'channel': {
+                'id': str(990000 + channel_id),
+                'title': 'Kanava %d' % channel_id,
+                'images': images(rng, 990000 + channel_id)
+            },
+            'epg': epg
+        })
+    routes['/dynamic/channels'] = channels
+
+    routes['/dynamic/search'] = {
+        'assets': [asset(rng, 600000 + n, 'movie') for n in range(SEARCH_SIZE)],
+        'categories': [series(rng, 650000 + n) for n in range(20)]
+    }
+
+    routes['/vimond/api/authentication/user/login.json'] = {'response': {'code': 'AUTHENTICATION_OK'}}
+
+    return routes
+
+
+def play_response(base_url, video_id):
+    return {
+        'playback': {
+            'drmProtected': True,
+            'items': {
+                'item': [
+                    {'mediaFormat': 'hls', 'url': base_url + '/media/%s.m3u8' % video_id},
+                    {
+                        'mediaFormat': 'mpd',
+                        'url': base_url + '/media/%s.mpd?exp=%d' % (video_id, time.time() + 6 * 3600),
+                        'license': {'@uri': base_url + '/license', '@name': 'com.widevine.alpha'}
+                    }
+                ]
+            }
+        }
+    }
+
+
+def encode(response):
+    return json.dumps(response).encode('utf-8')
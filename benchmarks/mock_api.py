@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP stand-in for the C More API serving the benchmark fixtures
+"""
+import re
+import time
+import hashlib
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import fixtures
+
+CATEGORY_RE = re.compile(r'^/dynamic/category/(\d+)/assets$')
+PAGE_RE = re.compile(r'^/dynamic/page/(\d+)$')
+PLAY_RE = re.compile(r'^/vimond/api/web/asset/([^/]+)/play\.json$')
+NOT_FOUND = {'error': {'code': 'NOT_FOUND'}}
+
+
+class MockApi(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.log = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.routes = fixtures.build(self.base_url)
+        self.bodies = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.log = []
+
+    def count(self, method, path, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += size
+            self.log.append((method, path, size))
+
+    def response_body(self, url):
+        """Return the encoded response for url or None if there is no such endpoint."""
+        if url in self.bodies:
+            return self.bodies[url]
+
+        parsed = urllib.parse.urlparse(url)
+        response = self.response_object(parsed.path)
+        if response is None:
+            return None
+
+        # Asset lists and search are paged with from and size
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        if 'size' in query and isinstance(response, dict):
+            start = int(query.get('from', 0))
+            end = start + int(query['size'])
+            paged = dict(response)
+            for key in ('result', 'assets', 'categories'):
+                if key in response:
+                    paged[key] = response[key][start:end]
+            if 'result' in response:
+                paged['totalHits'] = len(response['result'])
+            response = paged
+
+        body = fixtures.encode(response)
+        with self.lock:
+            self.bodies[url] = body
+        return body
+
+    def response_object(self, path):
+        if path in self.routes:
+            return self.routes[path]
+
+        match = CATEGORY_RE.match(path)
+        if match:
+            category_id = int(match.group(1))
+            if category_id < fixtures.PATH_COUNT:
+                response = fixtures.category_assets(category_id)
+            else:
+                response = fixtures.season_assets(category_id)
+        elif PAGE_RE.match(path):
+            response = fixtures.curated_page(int(PAGE_RE.match(path).group(1)))
+        elif PLAY_RE.match(path):
+            response = fixtures.play_response(self.base_url, PLAY_RE.match(path).group(1))
+        else:
+            return None
+
+        with self.lock:
+            self.routes[path] = response
+        return response
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def send_body(self, status, body, headers=None):
+                if api.latency:
+                    time.sleep(api.latency)
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                # Count before replying so the client never sees an uncounted response
+                api.count(self.command, self.path, len(body))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                body = api.response_body(self.path)
+                if body is None:
+                    return self.send_body(404, fixtures.encode(NOT_FOUND))
+
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send_body(304, b'', {'ETag': etag})
+                self.send_body(200, body, {'ETag': etag})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                body = api.response_body(self.path)
+                if body is None:
+                    return self.send_body(404, fixtures.encode(NOT_FOUND))
+                self.send_body(200, body, {'Set-Cookie': 'JSESSIONID=bench; Max-Age=86400; Path=/'})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
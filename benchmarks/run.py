@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark for the add-on router
+
+Runs router() end to end for each action against stub Kodi modules and a local
+stand-in for the C More API, and reports wall time, request count, bytes
+transferred and peak memory. The first run of every action starts from an
+empty profile folder (cold), the following runs reuse it (warm).
+
+Usage:
+    python benchmarks/run.py [--repeat N] [--latency MS] [--json FILE] [--compare FILE] [action ...]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import importlib
+import statistics
+import tracemalloc
+import urllib.parse
+from collections import OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCH_DIR)
+sys.path[0:0] = [os.path.join(BENCH_DIR, 'stubs'), BENCH_DIR, ADDON_DIR]
+
+import xbmc
+import xbmcaddon
+import xbmcplugin
+from mock_api import MockApi
+
+SEARCH_QUERY = 'helsinki'
+SETTINGS = {
+    'username': 'bench',
+    'password': 'bench',
+    '50fps': 'true',
+    'prefetch_seasons': 'true',
+    'prefetch_streams': '2'
+}
+
+
+def get_actions(base_url):
+    """Return the benchmarked actions as name: paramstring."""
+    dynamic_url = base_url + '/dynamic'
+    actions = OrderedDict()
+    actions['root'] = ''
+    actions['list_page'] = {'action': 'list_page', 'dataurl': dynamic_url + '/category/1/assets'}
+    actions['list_page_sport'] = {'action': 'list_page', 'dataurl': dynamic_url + '/sport'}
+    actions['list_page_channels'] = {'action': 'list_page', 'dataurl': dynamic_url + '/channels'}
+    actions['list_category_content'] = {'action': 'list_category_content', 'path': '/sivu/3'}
+    actions['list_category_content_curated'] = {'action': 'list_category_content', 'path': '/sivu/10'}
+    actions['search'] = {'action': 'search'}
+    actions['play'] = {'action': 'play', 'video_id': '1002'}
+    for name, params in actions.items():
+        if params:
+            actions[name] = urllib.parse.urlencode(params)
+    return actions
+
+
+def invoke(api, paramstring, profile):
+    """Run one plugin invocation like Kodi does, importing the add-on from scratch."""
+    for name in list(sys.modules):
+        if name == 'addon' or name == 'resources' or name.startswith('resources.'):
+            del sys.modules[name]
+    xbmcaddon.profile = profile
+    xbmcaddon.settings = dict(SETTINGS)
+    xbmc.keyboard_text = SEARCH_QUERY
+    xbmcplugin.reset()
+    sys.argv = ['plugin://plugin.video.cmorefi/', '1', '?' + paramstring]
+    # The user stays on the listing while background work finishes
+    xbmc.info_labels['Container.FolderPath'] = sys.argv[0] + sys.argv[2]
+
+    cmore = importlib.import_module('resources.lib.cmore')
+    cmore.CMore.CONFIG_URL = api.base_url + '/config'
+    cmore.CMore.LOGIN_URL = api.base_url + '/vimond/api/authentication/user/login.json'
+
+    # CMore debug logging goes to stdout, keep it out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        addon = importlib.import_module('addon')
+        try:
+            addon.router(paramstring)
+        finally:
+            addon.helper.c.close()
+
+    return len(xbmcplugin.items) + len(xbmcplugin.resolved)
+
+
+def measure(api, paramstring, profile):
+    api.reset_counters()
+    start = time.perf_counter()
+    items = invoke(api, paramstring, profile)
+    wall = time.perf_counter() - start
+    return {
+        'wall_ms': wall * 1000,
+        'requests': api.requests,
+        'bytes': api.bytes_sent,
+        'items': items
+    }
+
+
+def peak_memory(api, paramstring):
+    """Return the peak Python heap use in KiB of a cold invocation."""
+    profile = tempfile.mkdtemp(prefix='cmore-bench-')
+    try:
+        tracemalloc.start()
+        invoke(api, paramstring, profile)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+    return peak / 1024.0
+
+
+def run_action(api, paramstring, repeat):
+    profile = tempfile.mkdtemp(prefix='cmore-bench-')
+    try:
+        runs = [measure(api, paramstring, profile) for _ in range(repeat)]
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
+
+    cold = runs[0]
+    warm = runs[1:] or runs
+    return OrderedDict([
+        ('items', cold['items']),
+        ('cold_ms', round(cold['wall_ms'], 2)),
+        ('warm_ms', round(statistics.median(run['wall_ms'] for run in warm), 2)),
+        ('cold_requests', cold['requests']),
+        ('warm_requests', round(statistics.mean(run['requests'] for run in warm), 2)),
+        ('cold_bytes', cold['bytes']),
+        ('warm_bytes', round(statistics.mean(run['bytes'] for run in warm))),
+        ('peak_kib', round(peak_memory(api, paramstring), 1))
+    ])
+
+
+def print_report(results, baseline=None):
+    columns = list(next(iter(results.values())).keys())
+    name_width = max(len(name) for name in results) + 2
+    print(''.join(['action'.ljust(name_width)] + [column.rjust(15) for column in columns]))
+    for name, result in results.items():
+        cells = []
+        for column in columns:
+            cell = str(result[column])
+            if baseline and name in baseline and baseline[name].get(column):
+                change = (result[column] - baseline[name][column]) * 100.0 / baseline[name][column]
+                cell = '%s(%+.0f%%)' % (cell, change)
+            cells.append(cell.rjust(15))
+        print(name.ljust(name_width) + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the plugin router offline.')
+    parser.add_argument('actions', nargs='*', help='actions to run, all by default')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per action, the first one is cold')
+    parser.add_argument('--latency', type=float, default=20, help='simulated API latency in milliseconds')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='show changes against results written earlier with --json')
+    args = parser.parse_args()
+
+    api = MockApi(latency=args.latency / 1000.0).start()
+    try:
+        actions = get_actions(api.base_url)
+        results = OrderedDict()
+        for name in args.actions or actions.keys():
+            results[name] = run_action(api, actions[name], max(args.repeat, 1))
+    finally:
+        api.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh_baseline:
+            baseline = json.load(fh_baseline)
+    print_report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as fh_json:
+            json.dump(results, fh_json, indent=2)
+
+
+if __name__ == '__main__':
+    main()
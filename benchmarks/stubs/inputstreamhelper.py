@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal inputstreamhelper stand-in for running the add-on outside Kodi
+"""
+
+
+class Helper(object):
+    def __init__(self, protocol, drm=None):
+        self.protocol = protocol
+        self.drm = drm
+
+    def check_inputstream(self):
+        return True
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal xbmc stand-in for running the add-on outside Kodi
+"""
+import time
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGWARNING = 2
+LOGERROR = 3
+
+# Text returned by Keyboard.getText, set by the benchmark runner
+keyboard_text = ''
+# Builtins executed by the add-on, e.g. Container.Refresh
+builtins = []
+# Values returned by getInfoLabel, set by the benchmark runner
+info_labels = {}
+
+
+def log(msg, level=LOGDEBUG):
+    pass
+
+
+def executebuiltin(function, wait=False):
+    builtins.append(function)
+
+
+def sleep(time_ms):
+    time.sleep(time_ms / 1000.0)
+
+
+def getCondVisibility(condition):
+    return False
+
+
+def getInfoLabel(label):
+    return info_labels.get(label, '')
+
+
+class Keyboard(object):
+    def __init__(self, line='', heading='', hidden=False):
+        self.text = line
+
+    def doModal(self, autoclose=0):
+        self.text = keyboard_text
+
+    def isConfirmed(self):
+        return True
+
+    def getText(self):
+        return self.text
+
+
+class Monitor(object):
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=None):
+        if timeout:
+            time.sleep(timeout)
+        return False
+
+
+class Player(object):
+    def isPlaying(self):
+        return False
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal xbmcaddon stand-in backed by module level settings
+"""
+import os
+
+ADDON_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Profile folder and settings, set by the benchmark runner
+profile = ''
+settings = {}
+
+
+class Addon(object):
+    def __init__(self, id=None):
+        pass
+
+    def getAddonInfo(self, key):
+        return {
+            'id': 'plugin.video.cmorefi',
+            'version': 'bench',
+            'path': ADDON_PATH,
+            'profile': profile,
+            'icon': os.path.join(ADDON_PATH, 'resources', 'icon.png'),
+            'fanart': ''
+        }.get(key, '')
+
+    def getSetting(self, key):
+        return settings.get(key, '')
+
+    def setSetting(self, key, value):
+        settings[key] = value
+
+    def getLocalizedString(self, string_id):
+        return 'string %s' % string_id
+
+    def openSettings(self):
+        pass
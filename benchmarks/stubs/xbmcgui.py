@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal xbmcgui stand-in for running the add-on outside Kodi
+"""
+
+
+class ListItem(object):
+    def __init__(self, label='', label2='', path='', offscreen=False):
+        self.label = label
+        self.path = path
+        self.art = {}
+        self.info = {}
+        self.properties = {}
+
+    def setArt(self, values):
+        self.art.update(values)
+
+    def setInfo(self, type, infoLabels):
+        self.info.update(infoLabels)
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def getProperty(self, key):
+        return self.properties.get(key, '')
+
+
+class Dialog(object):
+    def ok(self, heading, message):
+        return True
+
+    def yesno(self, heading, message, nolabel='', yeslabel=''):
+        return True
+
+    def select(self, heading, options):
+        return 0
+
+    def textviewer(self, heading, text, usemono=False):
+        pass
+
+    def notification(self, heading, message, icon='', time=5000, sound=True):
+        pass
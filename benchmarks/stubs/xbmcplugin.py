@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal xbmcplugin stand-in that records what the add-on hands over to Kodi
+"""
+SORT_METHOD_NONE = 0
+SORT_METHOD_LABEL = 1
+SORT_METHOD_UNSORTED = 40
+
+# (url, listitem, is_folder) tuples added to the current directory
+items = []
+resolved = []
+directories_ended = 0
+
+
+def reset():
+    global directories_ended
+    del items[:]
+    del resolved[:]
+    directories_ended = 0
+
+
+def addDirectoryItem(handle, url, listitem, isFolder=False, totalItems=0):
+    items.append((url, listitem, isFolder))
+    return True
+
+
+def addDirectoryItems(handle, entries, totalItems=0):
+    items.extend(entries)
+    return True
+
+
+def setContent(handle, content):
+    pass
+
+
+def addSortMethod(handle, sortMethod, labelMask='', label2Mask=''):
+    pass
+
+
+def endOfDirectory(handle, succeeded=True, updateListing=False, cacheToDisc=True):
+    global directories_ended
+    directories_ended += 1
+
+
+def setResolvedUrl(handle, succeeded, listitem):
+    resolved.append(listitem)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal xbmcvfs stand-in for running the add-on outside Kodi
+"""
+import os
+
+
+def translatePath(path):
+    return path
+
+
+def exists(path):
+    return os.path.exists(path)
+
+
+def mkdir(path):
+    os.makedirs(path)
+    return True
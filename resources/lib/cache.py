@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk HTTP response cache for CMore
+"""
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+import threading
+import urllib.parse
+
+
+def write_atomic(path, data):
+    """Write data to path so that readers never see a partially written file."""
+    tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as fh_tmp:
+        fh_tmp.write(data)
+    os.replace(tmp_path, path)
+
+
+class ResponseCache(object):
+    """Responses stored zlib compressed in append-only segment files with an index.
+
+    Every record in a segment carries its key and metadata, so the index can
+    always be brought up to date by scanning what was appended after it was
+    saved. Each process appends to segments of its own and a record that
+    cannot be read back is a miss, which keeps concurrent plugin invocations
+    and the service safe without file locks. Replaced and evicted records stay
+    in their segments until compact() rewrites them.
+    """
+    RECORD_HEADER = struct.Struct('>4sII')
+    RECORD_MAGIC = b'CMC1'
+    # A process starts a new segment when its current one grows past this
+    SEGMENT_MAX_SIZE = 8 * 1024 * 1024
+    # Segments written to this recently may still be in use by another process and are not compacted
+    SEGMENT_SETTLE_TIME = 600
+    # Settled segments are compacted when this share of them is garbage or when there are more of them
+    COMPACT_GARBAGE_RATIO = 0.25
+    COMPACT_SEGMENT_COUNT = 16
+
+    def __init__(self, cache_dir, max_size=32 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.RLock()
+        # key: [segment, offset, size, meta, last access time]
+        self.entries = None
+        # segment: bytes of it reflected in entries
+        self.segments = None
+        self.segment = None
+        self.dirty = False
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def make_key(self, url, params=None):
+        """Return a file name safe cache key for the request."""
+        if isinstance(params, dict):
+            params = urllib.parse.urlencode(sorted(params.items()), doseq=True)
+        if params:
+            url = '%s?%s' % (url, params)
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def segment_path(self, segment):
+        return os.path.join(self.cache_dir, segment)
+
+    def load(self):
+        """Load the index and add the records appended to the segments since it was saved."""
+        with self.lock:
+            if self.entries is not None:
+                return
+            try:
+                with open(self.index_path) as fh_index:
+                    index = json.load(fh_index)
+                self.entries = index['entries']
+                self.segments = index['segments']
+            except (IOError, ValueError, KeyError):
+                self.entries = {}
+                self.segments = {}
+
+            names = set(name for name in os.listdir(self.cache_dir) if name.endswith('.seg'))
+            # Segments removed by compaction in another process
+            for segment in set(self.segments) - names:
+                del self.segments[segment]
+                self.dirty = True
+            for key, entry in list(self.entries.items()):
+                if entry[0] not in names:
+                    del self.entries[key]
+            for segment in sorted(names):
+                self.scan(segment)
+
+    def scan(self, segment):
+        """Index the records of segment after the part already indexed."""
+        offset = self.segments.get(segment, 0)
+        try:
+            with open(self.segment_path(segment), 'rb') as fh_segment:
+                fh_segment.seek(offset)
+                while True:
+                    header = fh_segment.read(self.RECORD_HEADER.size)
+                    if len(header) < self.RECORD_HEADER.size:
+                        break
+                    magic, meta_size, body_size = self.RECORD_HEADER.unpack(header)
+                    meta_data = fh_segment.read(meta_size)
+                    if magic != self.RECORD_MAGIC or len(meta_data) < meta_size:
+                        break
+                    fh_segment.seek(body_size, os.SEEK_CUR)
+                    size = self.RECORD_HEADER.size + meta_size + body_size
+                    meta = json.loads(meta_data)
+                    key = meta.pop('key')
+                    self.entries[key] = [segment, offset, size, meta, meta['fetched_at']]
+                    offset += size
+        except (IOError, ValueError, KeyError):
+            pass
+        # A record cut short by a crash ends the segment
+        if offset != self.segments.get(segment):
+            self.segments[segment] = offset
+            self.dirty = True
+
+    def get(self, key):
+        """Return the cached entry as a (meta, body) tuple or None if there is no entry."""
+        self.load()
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return None
+
+        segment, offset, size, meta = entry[:4]
+        try:
+            with open(self.segment_path(segment), 'rb') as fh_segment:
+                fh_segment.seek(offset)
+                record = fh_segment.read(size)
+            magic, meta_size, body_size = self.RECORD_HEADER.unpack_from(record)
+            body = zlib.decompress(record[self.RECORD_HEADER.size + meta_size:])
+        except (IOError, struct.error, zlib.error):
+            with self.lock:
+                self.entries.pop(key, None)
+            return None
+
+        # The access time is the LRU clock on eviction
+        with self.lock:
+            entry[4] = time.time()
+            self.dirty = True
+        return dict(meta), body
+
+    def get_age(self, meta):
+        return time.time() - meta['fetched_at']
+
+    def is_fresh(self, meta):
+        return self.get_age(meta) < meta['ttl']
+
+    def set(self, key, body, ttl, etag=None, last_modified=None):
+        self.load()
+        meta = {
+            'fetched_at': time.time(),
+            'ttl': ttl,
+            'etag': etag,
+            'last_modified': last_modified
+        }
+        meta_data = json.dumps(dict(meta, key=key), separators=(',', ':')).encode('utf-8')
+        body_data = zlib.compress(body)
+        record = self.RECORD_HEADER.pack(self.RECORD_MAGIC, len(meta_data), len(body_data)) + meta_data + body_data
+
+        with self.lock:
+            segment, offset = self.append(record)
+            self.entries[key] = [segment, offset, len(record), meta, meta['fetched_at']]
+            self.dirty = True
+        self.evict()
+
+    def append(self, record):
+        """Append record to the segment of this process and return the segment and the offset of the record."""
+        if self.segment is None or self.segments.get(self.segment, 0) > self.SEGMENT_MAX_SIZE:
+            self.segment = '%d-%d-%d.seg' % (time.time() * 1000, os.getpid(), threading.get_ident())
+            self.segments[self.segment] = 0
+        with open(self.segment_path(self.segment), 'ab') as fh_segment:
+            fh_segment.write(record)
+        offset = self.segments[self.segment]
+        self.segments[self.segment] = offset + len(record)
+        return self.segment, offset
+
+    def touch(self, key, ttl):
+        """Mark an entry as fresh again after a successful revalidation."""
+        self.load()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry[3] = dict(entry[3], fetched_at=time.time(), ttl=ttl)
+                entry[4] = time.time()
+                self.dirty = True
+
+    def evict(self):
+        """Remove least recently used entries from the index until they fit in max_size."""
+        self.load()
+        with self.lock:
+            total_size = sum(entry[2] for entry in self.entries.values())
+            if total_size <= self.max_size:
+                return
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1][4]):
+                del self.entries[key]
+                total_size -= entry[2]
+                self.dirty = True
+                if total_size <= self.max_size:
+                    break
+
+    def flush(self):
+        """Save the index if it changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            index = {'segments': self.segments, 'entries': self.entries}
+            write_atomic(self.index_path, json.dumps(index, separators=(',', ':')).encode('utf-8'))
+            self.dirty = False
+
+    def get_disk_size(self):
+        self.load()
+        return sum(self.segments.values())
+
+    def compact(self):
+        """Rewrite the live records of settled segments into new ones and remove the old segments."""
+        self.evict()
+        now = time.time()
+        with self.lock:
+            settled = []
+            for segment in self.segments:
+                try:
+                    if now - os.stat(self.segment_path(segment)).st_mtime > self.SEGMENT_SETTLE_TIME:
+                        settled.append(segment)
+                except OSError:
+                    pass
+            live = dict((segment, 0) for segment in settled)
+            for entry in self.entries.values():
+                if entry[0] in live:
+                    live[entry[0]] += entry[2]
+            settled_size = sum(self.segments[segment] for segment in settled)
+            garbage = settled_size - sum(live.values())
+            if garbage <= settled_size * self.COMPACT_GARBAGE_RATIO and len(settled) <= self.COMPACT_SEGMENT_COUNT:
+                return
+
+            self.segment = None
+            for key, entry in list(self.entries.items()):
+                if entry[0] not in live:
+                    continue
+                try:
+                    with open(self.segment_path(entry[0]), 'rb') as fh_segment:
+                        fh_segment.seek(entry[1])
+                        record = fh_segment.read(entry[2])
+                except IOError:
+                    del self.entries[key]
+                    continue
+                entry[0], entry[1] = self.append(record)
+            self.segment = None
+
+            # Save the index before removing the segments it no longer points to
+            self.dirty = True
+            self.flush()
+            for segment in settled:
+                del self.segments[segment]
+                try:
+                    os.remove(self.segment_path(segment))
+                except OSError:
+                    pass
+            self.dirty = True
+            self.flush()
+
+    def maintain(self):
+        """Evict to the size budget and compact the segments, for periodic housekeeping."""
+        with self.lock:
+            # Start from the records other processes appended since the index was loaded
+            self.flush()
+            self.entries = None
+            self.load()
+            self.compact()
+            self.flush()
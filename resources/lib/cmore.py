@@ -5,33 +5,180 @@ A Kodi-agnostic library for CMore
 import os
 import json
 import codecs
-import http.cookiejar
+import random
+import hashlib
+import threading
 import time
 import unicodedata
 import urllib.parse
 
 import calendar
-from datetime import datetime, timedelta
+from datetime import datetime
 
-import requests
+from .cache import ResponseCache, write_atomic
+from .trace import Tracer, get_endpoint
+from .search import SearchIndex
+from .epg import EpgStore
+
+class Asset(object):
+    """Asset, category or channel of an API response, parsed once for the renderers."""
+    __slots__ = ('kind', 'id', 'title', 'subtitle', 'description', 'cast', 'director', 'genre', 'duration',
+                 'year', 'country', 'mpaa', 'imdb', 'season', 'episode', 'landscape', 'portrait',
+                 'broadcast_time', 'live', 'id_50fps', 'groups', 'programs', 'fanart')
+    PROGRAMS_INDEX = __slots__.index('programs')
+
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        for slot in self.__slots__[1:]:
+            setattr(self, slot, fields.get(slot))
+
+    def to_list(self):
+        """Return the fields as a JSON serializable list."""
+        values = [getattr(self, slot) for slot in self.__slots__]
+        if self.programs:
+            values[self.PROGRAMS_INDEX] = [program.to_list() for program in self.programs]
+        return values
+
+    @classmethod
+    def from_list(cls, values):
+        asset = cls.__new__(cls)
+        # Lists stored before a field was added are shorter
+        values = list(values) + [None] * (len(cls.__slots__) - len(values))
+        for slot, value in zip(cls.__slots__, values):
+            setattr(asset, slot, value)
+        if asset.programs:
+            asset.programs = [cls.from_list(program) for program in asset.programs]
+        return asset
 
 class CMore(object):
-    def __init__(self, settings_folder, debug=False):
+    CONFIG_URL = 'https://www.katsomo.fi/mb/v3/static/svod/web/config/web'
+    LOGIN_URL = 'https://api.katsomo.fi/api/authentication/user/login.json'
+    # Cache lifetimes in seconds for GET requests per API
+    STATIC_CACHE_TTL = 3600
+    DYNAMIC_CACHE_TTL = 300
+    PATHS_INDEX_TTL = 3600
+    # Expired responses are still served, and revalidated afterwards, for this many seconds
+    STALE_MAX_AGE = 24 * 3600
+    # Number of items fetched per page from asset lists and search
+    PAGE_SIZE = 50
+    # Stored listing payloads not used for this many seconds are removed
+    PAYLOAD_MAX_AGE = 7 * 24 * 3600
+    # Concurrent requests and maximum number of asset lists for prefetching
+    PREFETCH_WORKERS = 4
+    PREFETCH_LIMIT = 12
+    # Resolved streams are reused for this many seconds, and never closer than
+    # STREAM_EXPIRY_MARGIN seconds to the expiry of a signed stream URL
+    STREAM_CACHE_TTL = 600
+    STREAM_EXPIRY_MARGIN = 60
+    # (connect, read) timeouts in seconds per API
+    STATIC_TIMEOUT = (5, 15)
+    DYNAMIC_TIMEOUT = (5, 15)
+    VIMOND_TIMEOUT = (5, 20)
+    DEFAULT_TIMEOUT = (5, 30)
+    # GET requests are retried on connection errors, timeouts and these status
+    # codes, waiting a random time of up to RETRY_BACKOFF * 2 ** attempt seconds
+    MAX_RETRIES = 2
+    RETRY_BACKOFF = 0.5
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+    # Connections kept open per host, enough for the prefetch workers and the main thread
+    POOL_SIZE = PREFETCH_WORKERS + 1
+    # The config in use is refreshed in the background once it is older than CONFIG_TTL
+    # seconds, trying again at most every CONFIG_RELOAD_INTERVAL seconds. It is also reloaded
+    # when a request to one of its APIs fails with a connection error or one of
+    # CONFIG_FAILURE_CODES, at most once per invocation or service cycle and not again
+    # within CONFIG_RELOAD_INTERVAL seconds of the last fetch.
+    CONFIG_VERSION = 1
+    CONFIG_KEYS = ('staticMbApiUrl', 'dynamicMbApiUrl', 'vimondApiUrl')
+    CONFIG_TTL = 24 * 3600
+    CONFIG_RELOAD_INTERVAL = 600
+    CONFIG_FAILURE_CODES = (404, 410)
+
+    def __init__(self, settings_folder, debug=False, trace=False, cache_size=32 * 1024 * 1024, thumb_width=480,
+                 fanart_width=1280):
         self.debug = debug
-        self.http_session = requests.Session()
         self.settings_folder = settings_folder
         self.tempdir = os.path.join(settings_folder, 'tmp')
         if not os.path.exists(self.tempdir):
             os.makedirs(self.tempdir)
-        self.cookie_jar = http.cookiejar.LWPCookieJar(os.path.join(self.settings_folder, 'cookie_file'))
+        self.cache = ResponseCache(os.path.join(self.tempdir, 'cache'), cache_size)
+        self.payload_dir = os.path.join(self.tempdir, 'payloads')
+        self.payloads_stored = False
+        self.stream_dir = os.path.join(self.tempdir, 'streams')
+        self.streams_stored = False
+        self.paths_index_path = os.path.join(self.settings_folder, 'paths_index.json')
+        self.paths_index = None
+        self.paths_index_refreshed = False
+        self.paths_lock = threading.RLock()
+        # (url, params, body) of the responses served stale during this invocation
+        self.stale_responses = []
+        # Local UTC offsets by hour since the epoch, shared by all timestamps of an invocation
+        self.utc_offsets = {}
+        # Images are picked as the smallest rendition at least this many pixels wide
+        self.thumb_width = thumb_width
+        self.fanart_width = fanart_width
+        self.credentials = None
+        self.epg = EpgStore(os.path.join(self.settings_folder, 'epg.json'))
+        self.search_index = SearchIndex(os.path.join(self.settings_folder, 'search'))
+        self.tracer = Tracer(os.path.join(self.settings_folder, 'trace.jsonl'), enabled=trace)
+        self.cookie_path = os.path.join(self.settings_folder, 'cookie_file')
         self.config_path = os.path.join(self.settings_folder, 'configuration.json')
-        self.config = self.get_config()
+        # The HTTP session, cookies and config are loaded on first use so that
+        # routes which never touch the network start fast
+        self._http_session = None
+        self._cookie_jar = None
+        self._config = None
+        self.config_entry = None
+        self.config_checked_at = 0
+        self.config_reloaded = False
+        # The config replaced by the last refresh, requests built from it may still be under way
+        self.previous_config = None
+        self.config_reload_lock = threading.Lock()
+        self._pool = None
+        self.init_lock = threading.RLock()
 
-        try:
-            self.cookie_jar.load(ignore_discard=True, ignore_expires=True)
-        except IOError:
-            pass
-        self.http_session.cookies = self.cookie_jar
+    @property
+    def http_session(self):
+        with self.init_lock:
+            if self._http_session is None:
+                import requests
+                session = requests.Session()
+                session.cookies = self.cookie_jar
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._http_session = session
+        return self._http_session
+
+    @property
+    def cookie_jar(self):
+        with self.init_lock:
+            if self._cookie_jar is None:
+                from .cookies import SessionCookieJar
+                cookie_jar = SessionCookieJar(self.cookie_path)
+                try:
+                    cookie_jar.load(ignore_discard=True, ignore_expires=True)
+                except IOError:
+                    pass
+                self._cookie_jar = cookie_jar
+        return self._cookie_jar
+
+    @property
+    def pool(self):
+        """Thread pool shared by concurrent fetches, it reuses the connections of http_session."""
+        with self.init_lock:
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(max_workers=self.PREFETCH_WORKERS)
+        return self._pool
+
+    @property
+    def config(self):
+        with self.init_lock:
+            if self._config is None:
+                self._config = self.get_config()
+            elif self.is_config_expired():
+                self.refresh_config_later()
+        return self._config
 
     class CMoreError(Exception):
         def __init__(self, value):
@@ -52,36 +199,247 @@ class CMore(object):
             except:
                 pass
 
-    def make_request(self, url, method, params=None, payload=None, headers=None):
-        """Make an HTTP request. Return the response."""
+    def make_request(self, url, method, params=None, payload=None, headers=None, refresh=False, reauth=True,
+                     stale_ok=False):
+        """Make an HTTP request and return the decoded JSON response.
+        Use refresh to revalidate cached responses even if they are still fresh. With stale_ok an
+        expired response is returned as is and revalidated later by revalidate_stale."""
         self.log('Request URL: %s' % url)
         self.log('Method: %s' % method)
         self.log('Params: %s' % params)
         self.log('Payload: %s' % payload)
         self.log('Headers: %s' % headers)
+
+        started = time.perf_counter()
+        cache_ttl = self.get_cache_ttl(url) if method == 'get' else 0
+        cached = None
+        if cache_ttl:
+            cache_key = self.cache.make_key(url, params)
+            cached = self.cache.get(cache_key)
+            if cached:
+                meta, body = cached
+                if self.cache.is_fresh(meta) and not refresh:
+                    self.log('Cache hit: %s' % url)
+                    return self.decode_response(url, body, started, 'hit')
+                if stale_ok and not refresh and self.cache.get_age(meta) < meta['ttl'] + self.STALE_MAX_AGE:
+                    self.log('Cache hit, stale: %s' % url)
+                    self.stale_responses.append((url, params, body))
+                    return self.decode_response(url, body, started, 'stale')
+                # Revalidate the stale entry with a conditional request
+                headers = dict(headers) if headers else {}
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+        import requests
         try:
-            if method == 'get':
-                req = self.http_session.get(url, params=params, headers=headers)
-            elif method == 'put':
-                req = self.http_session.put(url, params=params, data=payload, headers=headers)
-            else:  # post
-                req = self.http_session.post(url, params=params, data=payload, headers=headers)
+            req = self.send_request(url, method, params=params, payload=payload, headers=headers)
             self.log('Response code: %s' % req.status_code)
             # self.log('Response: %s' % req.content)
-            self.cookie_jar.save(ignore_discard=True, ignore_expires=False)
-            self.raise_cmore_error(req.content)
-            return req.content
+            if req.status_code in self.CONFIG_FAILURE_CODES:
+                moved_url = self.reload_config(url)
+                if moved_url:
+                    return self.make_request(moved_url, method, params=params, payload=payload, headers=headers,
+                                             refresh=refresh, reauth=reauth, stale_ok=stale_ok)
+            if cached and req.status_code == 304:
+                self.log('Cache revalidated: %s' % url)
+                self.cache.touch(cache_key, cache_ttl)
+                return self.decode_response(url, cached[1], started, 'revalidated', req.status_code)
+
+            data = self.decode_response(url, req.content, started, 'miss' if cache_ttl else None, req.status_code)
+            try:
+                self.raise_cmore_error(data)
+            except self.CMoreError as error:
+                # Session cookies were rejected, log in again and retry the request once
+                if error.value == 'AUTHENTICATION_FAILED' and reauth and self.credentials and url != self.LOGIN_URL:
+                    self.log('Session expired, logging in again.')
+                    self.login()
+                    return self.make_request(url, method, params=params, payload=payload, headers=headers,
+                                             refresh=refresh, reauth=False)
+                raise
+            if cache_ttl and req.status_code == 200:
+                self.cache.set(cache_key, req.content, cache_ttl,
+                               etag=req.headers.get('ETag'), last_modified=req.headers.get('Last-Modified'))
+            return data
 
         except requests.exceptions.ConnectionError as error:
-            self.log('Connection Error: - %s' % error.message)
-            raise
+            self.log('Connection Error: - %s' % error)
+            self.trace_request(url, started, error=type(error).__name__)
+            moved_url = self.reload_config(url)
+            if not moved_url:
+                raise
+            return self.make_request(moved_url, method, params=params, payload=payload, headers=headers,
+                                     refresh=refresh, reauth=reauth, stale_ok=stale_ok)
         except requests.exceptions.RequestException as error:
-            self.log('Error: - %s' % error.value)
-            raise
+            self.log('Error: - %s' % error)
+            self.trace_request(url, started, error=type(error).__name__)
+            moved_url = self.reload_config(url)
+            if not moved_url:
+                raise
+            return self.make_request(moved_url, method, params=params, payload=payload, headers=headers,
+                                     refresh=refresh, reauth=reauth, stale_ok=stale_ok)
 
-    def raise_cmore_error(self, response):
+    def decode_response(self, url, body, started, cache=None, status=None):
+        """Decode a JSON response body and add the request to the trace."""
+        decode_started = time.perf_counter()
+        data = json.loads(body)
+        if self.tracer.enabled:
+            decode_ms = round((time.perf_counter() - decode_started) * 1000, 2)
+            self.trace_request(url, started, cache=cache, status=status, bytes=len(body), decode_ms=decode_ms)
+        return data
+
+    def trace_request(self, url, started, **fields):
+        self.tracer.record('request', get_endpoint(url), ms=round((time.perf_counter() - started) * 1000, 2),
+                           **fields)
+
+    def send_request(self, url, method, params=None, payload=None, headers=None):
+        """Send the request with the timeout of its API. GET requests are idempotent and
+        retried with a jittered exponential backoff on connection errors and server errors."""
+        import requests
+        timeout = self.get_timeout(url)
+        retries = self.MAX_RETRIES if method == 'get' else 0
+        for attempt in range(retries + 1):
+            try:
+                if method == 'get':
+                    req = self.http_session.get(url, params=params, headers=headers, timeout=timeout)
+                elif method == 'put':
+                    req = self.http_session.put(url, params=params, data=payload, headers=headers, timeout=timeout)
+                else:  # post
+                    req = self.http_session.post(url, params=params, data=payload, headers=headers, timeout=timeout)
+                if req.status_code not in self.RETRY_STATUS_CODES or attempt == retries:
+                    return req
+                self.log('Server error %s, retrying.' % req.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                if attempt == retries:
+                    raise
+                self.log('Request failed, retrying: %s' % error)
+            time.sleep(random.uniform(0, self.RETRY_BACKOFF * 2 ** attempt))
+
+    def get_timeout(self, url):
+        """Return the (connect, read) timeout for a request to url."""
+        if url == self.CONFIG_URL:
+            return self.STATIC_TIMEOUT
+        if url == self.LOGIN_URL:
+            return self.VIMOND_TIMEOUT
+        for api, timeout in (('staticMbApiUrl', self.STATIC_TIMEOUT), ('dynamicMbApiUrl', self.DYNAMIC_TIMEOUT),
+                             ('vimondApiUrl', self.VIMOND_TIMEOUT)):
+            if url.startswith(self.config[api]):
+                return timeout
+        return self.DEFAULT_TIMEOUT
+
+    def revalidate_stale(self):
+        """Revalidate the responses served stale so far concurrently, return True if any of them changed."""
+        stale, self.stale_responses = self.stale_responses, []
+        changed = []
+
+        def revalidate(response):
+            url, params, body = response
+            self.make_request(url, 'get', params=params, refresh=True)
+            entry = self.cache.get(self.cache.make_key(url, params))
+            if entry and entry[1] != body:
+                changed.append(url)
+
+        self.run_parallel(revalidate, stale)
+        return bool(changed)
+
+    def save_cookies(self):
+        """Write the cookie jar to disk if any cookie changed."""
+        if self._cookie_jar is not None and self._cookie_jar.dirty:
+            self.log('Saving cookies.')
+            self.cookie_jar.save_atomic()
+
+    def close(self):
+        """Flush pending state at the end of the plugin invocation."""
+        if self._pool is not None:
+            # Let background fetches finish, they fill the cache for the next invocation
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        # The service keeps this object between cycles. Each cycle starts with a new chance
+        # to reload the config on failures
+        self.config_reloaded = False
+        self.save_cookies()
+        # and from the cookies on disk, which the plugin may have renewed since
+        with self.init_lock:
+            if self._http_session is not None:
+                self._http_session.close()
+            self._http_session = None
+            self._cookie_jar = None
+        self.epg.save()
+        self.cache.flush()
+        self.tracer.flush()
+        if self.payloads_stored:
+            self.prune_directory(self.payload_dir, self.PAYLOAD_MAX_AGE)
+        if self.streams_stored:
+            self.prune_directory(self.stream_dir, self.STREAM_CACHE_TTL)
+
+    def maintain_cache(self):
+        """Compact the response cache and remove expired files, for periodic housekeeping."""
+        self.cache.maintain()
+        # Listings queue their assets for the search index, merge them for users who never search
+        self.search_index.merge_pending()
+        for directory, max_age in ((self.payload_dir, self.PAYLOAD_MAX_AGE), (self.stream_dir, self.STREAM_CACHE_TTL)):
+            if os.path.isdir(directory):
+                self.prune_directory(directory, max_age)
+        # Responses cached one file per entry by earlier versions
+        for name in os.listdir(self.tempdir):
+            if name.endswith('.body') or name.endswith('.json'):
+                try:
+                    os.remove(os.path.join(self.tempdir, name))
+                except OSError:
+                    pass
+
+    def store_payload(self, payload):
+        """Store a JSON serializable payload and return the short content hash key it can be loaded with."""
+        data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        key = hashlib.sha1(data).hexdigest()[:20]
+        path = os.path.join(self.payload_dir, key + '.json')
+        if os.path.exists(path):
+            # Listed again, keep it from being pruned
+            os.utime(path, None)
+        else:
+            os.makedirs(self.payload_dir, exist_ok=True)
+            write_atomic(path, data)
+            self.payloads_stored = True
+        return key
+
+    def load_payload(self, key):
+        """Return the payload stored under key, None if it has been pruned."""
+        path = os.path.join(self.payload_dir, os.path.basename(key) + '.json')
+        try:
+            with open(path, 'rb') as fh_payload:
+                payload = json.loads(fh_payload.read())
+        except (IOError, ValueError):
+            self.log('Payload %s not found.' % key)
+            return None
+        # Keep payloads that are still in use from being pruned
+        os.utime(path, None)
+        return payload
+
+    def prune_directory(self, directory, max_age):
+        """Remove files in directory that have not been modified for max_age seconds."""
+        now = time.time()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if now - os.stat(path).st_mtime > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get_cache_ttl(self, url):
+        """Return the cache lifetime for a GET request to url, 0 if it should not be cached."""
+        if url == self.CONFIG_URL:
+            return 0
+        if url.startswith(self.config['staticMbApiUrl']):
+            return self.STATIC_CACHE_TTL
+        if url.startswith(self.config['dynamicMbApiUrl']):
+            return self.DYNAMIC_CACHE_TTL
+        return 0
+
+    def raise_cmore_error(self, error):
+        """Raise CMoreError if the decoded response is an error message."""
         try:
-            error = json.loads(response)
             if isinstance(error, dict):
                 if 'error' in error.keys():
                     if 'message' in error['error'].keys():
@@ -100,30 +458,157 @@ class CMore(object):
             pass
         except KeyError:
             pass
-        except ValueError:  # when response is not in json
-            pass
 
     def get_config(self):
-        """Return the config in a dict."""
+        """Return the config in a dict, downloading it only if there is no valid stored copy."""
+        entry = self.load_config()
+        if entry is None:
+            entry = self.download_config()
+        self.config_entry = entry
+        if self.is_config_expired():
+            # Start with the stored config, the refreshed one is used as soon as it arrives
+            self.refresh_config_later()
+        return entry['data']
+
+    def is_config_expired(self):
+        """Return True if the config in use is due for a refresh that was not tried lately."""
+        now = time.time()
+        return now - self.config_entry['fetched_at'] > self.CONFIG_TTL and \
+            now - self.config_checked_at > self.CONFIG_RELOAD_INTERVAL
+
+    def refresh_config_later(self):
+        self.config_checked_at = time.time()
+        self.pool.submit(self.call_logged, self.refresh_config)
+
+    def load_config(self):
+        """Return the stored config entry or None if there is no valid one."""
         try:
-            config = json.load(open(self.config_path))
-        except IOError:
-            self.download_config()
-            config = json.load(open(self.config_path))
+            with open(self.config_path) as fh_config:
+                entry = json.load(fh_config)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(entry, dict):
+            return None
+        if entry.get('version') != self.CONFIG_VERSION:
+            # Earlier versions stored the bare config, keep using it until it is refreshed
+            entry = {'version': self.CONFIG_VERSION, 'fetched_at': 0, 'etag': None, 'last_modified': None,
+                     'data': entry}
+        if not self.is_valid_config(entry.get('data')):
+            return None
+        return entry
+
+    def is_valid_config(self, config):
+        """Return True if config has the base URLs of all APIs."""
+        if not isinstance(config, dict):
+            return False
+        return all(isinstance(config.get(key), str) and config[key].startswith('http') for key in self.CONFIG_KEYS)
+
+    def download_config(self, entry=None):
+        """Download and store the C More configuration, conditionally if entry is the stored copy.
+        Return the new entry."""
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        started = time.perf_counter()
+        req = self.send_request(self.CONFIG_URL, 'get', headers=headers)
+        if entry and req.status_code == 304:
+            self.trace_request(self.CONFIG_URL, started, cache='revalidated', status=req.status_code)
+            self.log('The configuration is unchanged.')
+            entry = dict(entry, fetched_at=time.time())
+        else:
+            self.trace_request(self.CONFIG_URL, started, status=req.status_code, bytes=len(req.content))
+            try:
+                config = json.loads(req.content)
+            except ValueError:
+                config = None
+            if req.status_code != 200 or not self.is_valid_config(config):
+                raise self.CMoreError('Invalid configuration, response code %s' % req.status_code)
+            self.log('The configuration is %s' % config)
+            entry = {
+                'version': self.CONFIG_VERSION,
+                'fetched_at': time.time(),
+                'etag': req.headers.get('ETag'),
+                'last_modified': req.headers.get('Last-Modified'),
+                'data': config
+            }
+        write_atomic(self.config_path, json.dumps(entry).encode('utf-8'))
+        return entry
+
+    def refresh_config(self):
+        """Download the config again if it changed and use it for the following requests."""
+        config = self.config
+        entry = self.download_config(self.config_entry)
+        with self.init_lock:
+            self.config_entry = entry
+            self._config = entry['data']
+            if entry['data'] != config:
+                self.previous_config = config
+        if entry['data'] != config:
+            self.log('The configuration changed.')
+
+    def get_api_base(self, url):
+        """Return the config key and the base URL of the API url belongs to, looking at the
+        current and the previous config, or None if it belongs to neither."""
+        for config in (self.config, self.previous_config):
+            for key in self.CONFIG_KEYS:
+                if config and url.startswith(config[key]):
+                    return key, config[key]
+        return None
 
-        return config
+    def reload_config(self, url):
+        """Refresh the config after a request to url failed. Return url moved to the new
+        base URL of its API if that changed, None otherwise.
 
-    def download_config(self):
-        """Download the C More configuration."""
-        url = 'https://www.katsomo.fi/mb/v3/static/svod/web/config/web'
+        The config is downloaded at most once per invocation or service cycle. Requests
+        failing while that runs wait for it and are moved to the new base URL as well.
+        """
+        if url in (self.CONFIG_URL, self.LOGIN_URL):
+            return None
+        with self.config_reload_lock:
+            api = self.get_api_base(url)
+            if api is None:
+                return None
+            key, base = api
+            if base == self.config[key] and not self.config_reloaded and \
+                    time.time() - self.config_entry['fetched_at'] >= self.CONFIG_RELOAD_INTERVAL:
+                self.config_reloaded = True
+                self.log('Request to %s failed, reloading the configuration.' % url)
+                try:
+                    self.refresh_config()
+                except (IOError, ValueError, self.CMoreError) as error:
+                    self.log('Reloading the configuration failed: %s' % error)
+                    return None
+            new_base = self.config[key]
+        if new_base == base:
+            return None
+        return new_base + url[len(base):]
 
-        config_data = self.make_request(url, 'get', params='')
-        self.log("The configuration is %s" % config_data)
-        with open(self.config_path, 'wb') as fh_config:
-            fh_config.write(config_data)
+    def set_credentials(self, username, password):
+        """Store the credentials used to renew the session when it expires."""
+        self.credentials = (username, password)
+
+    def has_valid_session(self):
+        """Return True if the cookie jar holds unexpired cookies for the authentication domain."""
+        auth_host = urllib.parse.urlparse(self.LOGIN_URL).hostname
+        now = time.time()
+        cookies = [cookie for cookie in self.cookie_jar if auth_host.endswith(cookie.domain.lstrip('.'))]
+        if not cookies:
+            return False
+        return not any(cookie.is_expired(now) for cookie in cookies)
+
+    def ensure_login(self):
+        """Log in only if there is no valid session."""
+        if self.has_valid_session():
+            self.log('Using existing session.')
+            return
+        self.login()
 
     def login(self, username=None, password=None):
-        url = 'https://api.katsomo.fi/api/authentication/user/login.json'
+        url = self.LOGIN_URL
+        if not username and self.credentials:
+            username, password = self.credentials
 
         method = 'post'
         payload = {
@@ -134,50 +619,244 @@ class CMore(object):
 
         return self.make_request(url, method, payload=payload)
 
-    def get_search_data(self, query):
+    def get_search_data(self, query, offset=0):
+        """Return one page of search results and the offset of the next page, None on the last page."""
         url = self.config['dynamicMbApiUrl'] + '/search'
         params = {
             'query': query,
-            'size': 100
+            'from': offset,
+            'size': self.PAGE_SIZE
         }
 
-        data = json.loads(self.make_request(url, 'get', params=params))
-        return data['assets'] + data['categories']
+        data = self.make_request(url, 'get', params=params)
+        if len(data['assets']) >= self.PAGE_SIZE or len(data['categories']) >= self.PAGE_SIZE:
+            next_offset = offset + self.PAGE_SIZE
+        else:
+            next_offset = None
+        return data['assets'] + data['categories'], next_offset
+
+    def search_local(self, query):
+        """Return the assets already seen while browsing that match query."""
+        return [Asset.from_list(doc) for doc in self.search_index.search(query)]
+
+    def merge_assets(self, *asset_lists):
+        """Return the assets of the lists in order, leaving out the ones an earlier list already had."""
+        seen = set()
+        merged = []
+        for assets in asset_lists:
+            for asset in assets:
+                key = '%s:%s' % (asset.kind, asset.id)
+                if key not in seen:
+                    seen.add(key)
+                    merged.append(asset)
+        return merged
+
+    def index_assets(self, assets):
+        """Make listed assets searchable locally."""
+        self.search_index.add_pending(assets)
+
+    def get_paths_index(self, refresh=False):
+        """Return the /paths table as a list of [type, dataUrl, path] rows with the
+        positions of the rows keyed by visibleUrl and path."""
+        if self.paths_index and not refresh:
+            return self.paths_index
+
+        # Threads looking up paths at the same time wait for a single load
+        with self.paths_lock:
+            if self.paths_index and not refresh:
+                return self.paths_index
+
+            paths_url = self.config['staticMbApiUrl'] + '/paths'
+            if not refresh:
+                try:
+                    with open(self.paths_index_path) as fh_index:
+                        index = json.load(fh_index)
+                    if index['url'] == paths_url and 'rows' in index and \
+                            time.time() - index['fetched_at'] < self.PATHS_INDEX_TTL:
+                        self.paths_index = index
+                        return index
+                except (IOError, ValueError, KeyError):
+                    pass
+
+            index = {
+                'url': paths_url,
+                'fetched_at': time.time(),
+                'rows': [],
+                'visibleUrl': {},
+                'path': {}
+            }
+            # Keep the first match for duplicate keys like the linear scan did
+            for i in self.get_page(page_type='/paths', refresh=refresh):
+                position = len(index['rows'])
+                index['rows'].append([i.get('type'), i.get('dataUrl'), i.get('path')])
+                index['visibleUrl'].setdefault(i['visibleUrl'], position)
+                index['path'].setdefault(i['path'], position)
+
+            write_atomic(self.paths_index_path, json.dumps(index, separators=(',', ':')).encode('utf-8'))
+            self.paths_index = index
+            self.paths_index_refreshed = refresh
+            return index
+
+    def lookup_path(self, key, value):
+        """Return the type, dataUrl and path of the /paths entry whose key matches value in a dict,
+        refreshing the index once on a miss."""
+        index = self.get_paths_index()
+        position = index[key].get(value)
+        if position is None and not self.paths_index_refreshed:
+            self.log('Path %s not in index, refreshing.' % value)
+            index = self.get_paths_index(refresh=True)
+            position = index[key].get(value)
+        if position is None:
+            return None
+        return dict(zip(('type', 'dataUrl', 'path'), index['rows'][position]))
 
     def get_path_dataurl(self, path):
-        paths = self.get_page(page_type='/paths')
-        for i in paths:
-            if i['visibleUrl'] == path:
-                return i
+        return self.lookup_path('visibleUrl', path)
 
     # Get actual dataurl for target and return content
-    def get_target_path(self, target):
-        paths = self.get_page(page_type='/paths')
+    def get_target_path(self, target, offset=0, stale_ok=False):
         parsed = urllib.parse.urlparse(target)
+        i = self.lookup_path('path', parsed.path)
 
-        for i in paths:
-            if i['path'] == parsed.path:
+        if i:
+            params = {
+                'sort': urllib.parse.parse_qs(parsed.query)['sort'],
+                'from': offset,
+                'size': self.PAGE_SIZE
+            }
+            data = self.make_request(i['dataUrl'], 'get', params=params, stale_ok=stale_ok)
 
-                params = {
-                    'sort': urllib.parse.parse_qs(parsed.query)['sort'],
-                    'size': 100
-                }
-                data = json.loads(self.make_request(i['dataUrl'], 'get', params=params))
+            return data['result'], self.get_next_offset(data, data['result'], offset)
 
-                return data['result']
+        return [], None
 
-    def get_page(self, page_type=None, dataurl=None):
+    def get_page(self, page_type=None, dataurl=None, refresh=False, params=None, stale_ok=False):
         if dataurl:
             url = dataurl
         else:
             url = self.config['staticMbApiUrl'] + page_type
 
-        data = json.loads(self.make_request(url, 'get'))
+        data = self.make_request(url, 'get', params=params, refresh=refresh, stale_ok=stale_ok)
         return data
 
-    def parse_page(self, dataurl=None):
-        page = self.get_page(dataurl=dataurl)
+    def get_assets_page(self, dataurl, offset=0, refresh=False, stale_ok=False):
+        """Return one page of items from an asset list and the offset of the next page, None on the last page."""
+        # Paging parameters replace any size already in the data url
+        parsed = urllib.parse.urlparse(dataurl)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        params['from'] = offset
+        params['size'] = self.PAGE_SIZE
+
+        page = self.get_page(dataurl=parsed._replace(query='').geturl(), params=params, refresh=refresh,
+                             stale_ok=stale_ok)
+        items = self.parse_page_data(page)
+        return items, self.get_next_offset(page, items, offset)
+
+    def get_section_paths(self, tree):
+        """Return the paths of the sections the main pages in tree lead to."""
+        paths = []
+        for page in tree:
+            if page['subs']:
+                paths.extend(sub['path'] for sub in page['subs'])
+            else:
+                paths.append(page['path'])
+        return paths
+
+    def get_main_page_subs(self, main_path):
+        """Return the subcategories of the main menu page at main_path, None if there is no such page."""
+        for page in self.get_page(page_type='/tree', stale_ok=True):
+            if page['path'] == main_path:
+                return page['subs']
+        return None
+
+    def get_section(self, path, refresh=False):
+        """Return the first page of the section at path, None if there is no such section."""
+        section = self.get_path_dataurl(path)
+        if not section:
+            return None
+        if section['type'] == 'curated':
+            return self.get_page(dataurl=section['dataUrl'], refresh=refresh)
+        return self.get_assets_page(section['dataUrl'], refresh=refresh)
+
+    def refresh_section(self, path):
+        """Revalidate the cached first page of the section at path."""
+        self.get_section(path, refresh=True)
+
+    def fetch_many(self, items, function=None):
+        """Call function for each item concurrently and yield (item, result) tuples as they complete.
+
+        function defaults to fetching and parsing the page with the item as
+        dataurl. Failures are logged and yield None as the result.
+        """
+        from concurrent.futures import as_completed
+        if function is None:
+            function = lambda dataurl: self.parse_page_data(self.get_page(dataurl=dataurl))
+        futures = dict((self.pool.submit(function, item), item) for item in items)
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result()
+            except (IOError, self.CMoreError, ValueError, KeyError) as error:
+                self.log('Fetching %s failed: %s' % (item, error))
+                yield item, None
+
+    def run_parallel(self, function, items):
+        """Call function for each item concurrently and wait for all of them, logging failures instead of raising them."""
+        for _ in self.fetch_many(items, function):
+            pass
+
+    def fetch_main_pages(self, warm_sections=False, stale_ok=False):
+        """Return the main menu. Runs on the pool while the session is checked, the /paths index
+        and, if warm_sections is set, the sections the menu opens directly are fetched alongside."""
+        self.pool.submit(self.call_logged, self.get_paths_index)
+        pages = self.get_page(page_type='/tree', stale_ok=stale_ok)
+        if warm_sections:
+            # Menu pages with more than one subcategory only list them, no request is needed
+            paths = [page['subs'][0]['path'] if page['subs'] else page['path']
+                     for page in pages if len(page['subs']) <= 1]
+            for path in paths[:self.PREFETCH_LIMIT]:
+                self.pool.submit(self.call_logged, self.get_section, path)
+        return pages
+
+    def call_logged(self, function, *args):
+        """Call function logging failures instead of raising them, for fire and forget pool tasks."""
+        try:
+            return function(*args)
+        except (IOError, self.CMoreError, ValueError, KeyError) as error:
+            self.log('%s failed: %s' % (function.__name__, error))
+
+    def prefetch_targets(self, targets):
+        """Fetch the first page of the asset lists behind target paths concurrently into the response cache."""
+        targets = targets[:self.PREFETCH_LIMIT]
+        self.log('Prefetching %d targets.' % len(targets))
+        self.run_parallel(self.get_target_path, targets)
+
+    def prefetch_assets(self, dataurls):
+        """Fetch the first page of each asset list concurrently into the response cache."""
+        dataurls = dataurls[:self.PREFETCH_LIMIT]
+        self.log('Prefetching %d asset lists.' % len(dataurls))
+        self.run_parallel(self.get_assets_page, dataurls)
+
+    def prefetch_streams(self, video_ids):
+        """Resolve the streams of video_ids concurrently so playback can start without a play.json request."""
+        self.log('Prefetching %d streams.' % len(video_ids))
+        self.run_parallel(self.get_stream, video_ids)
+
+    def get_next_offset(self, page, items, offset):
+        """Return the offset of the page after items, None if this was the last page."""
+        # Only asset lists in a result key are paged
+        if not items or not isinstance(page, dict) or 'result' not in page:
+            return None
+        next_offset = offset + len(items)
+        if 'totalHits' in page:
+            return next_offset if next_offset < page['totalHits'] else None
+        return next_offset if len(items) >= self.PAGE_SIZE else None
 
+    def parse_page(self, dataurl=None, stale_ok=False):
+        page = self.get_page(dataurl=dataurl, stale_ok=stale_ok)
+        return self.parse_page_data(page)
+
+    def parse_page_data(self, page):
         if isinstance(page, list):
             return page
         elif 'result' in page.keys():
@@ -190,12 +869,183 @@ class CMore(object):
         self.log('Failed to parse page.')
         return False
 
-    def get_stream(self, video_id):
+    def parse_assets(self, items):
+        """Return the items of a page as Asset objects, skipping items no renderer handles."""
+        assets = []
+        for i in items or []:
+            asset = self.parse_item(i)
+            if asset:
+                assets.append(asset)
+        return assets
+
+    def parse_item(self, i):
+        # Favorites and featured wrap the asset or category
+        if i.get('asset'):
+            # Sport (Live formula, live sport) or movie
+            return self.parse_asset(i['asset'], 'event' if i['asset']['type'] == 'sport' else 'movie')
+        if i.get('category'):
+            return self.parse_asset(i['category'], 'tvshow')
+
+        item_type = i.get('type')
+        if item_type == 'movie':
+            return self.parse_asset(i, 'movie')
+        elif item_type == 'series':
+            # Series with seasons in data, otherwise a season
+            return self.parse_asset(i, 'tvshow' if i.get('groups') else 'season')
+        elif item_type == 'sport':
+            # F1 and sport categories list folders
+            return self.parse_asset(i, 'season' if 'groups' in i else 'event')
+        elif i.get('channel'):
+            return self.parse_channel(i)
+        elif item_type == 'episode':
+            return self.parse_asset(i, 'episode')
+        return None
+
+    def parse_asset(self, i, kind):
+        images = i.get('images') or {}
+        # If program name is number for example 112
+        title = str(i['title']) if isinstance(i.get('title'), int) else i.get('title')
+        actors = i.get('actors')
+
+        return Asset(
+            kind,
+            id=i.get('id'),
+            title=title,
+            subtitle=i.get('subtitle'),
+            description=i.get('description'),
+            cast=actors.split(', ') if actors else [],
+            director=i.get('director'),
+            genre=', '.join(i['genres']) if i.get('genres') else None,
+            duration=i.get('duration'),
+            year=i.get('productionYear'),
+            country=i.get('productionCountries'),
+            mpaa=i.get('parentalRating'),
+            imdb=i.get('imdbId') or None,
+            season=i.get('season'),
+            episode=i.get('episode'),
+            landscape=self.get_image(images, 'landscape', self.thumb_width),
+            portrait=self.get_image(images, 'portrait', self.thumb_width),
+            fanart=self.get_image(images, 'landscape', self.fanart_width),
+            broadcast_time=self.parse_timestamp(event_date=i['liveBroadcastTime']) if i.get('liveBroadcastTime') else None,
+            live=i.get('live'),
+            id_50fps=i.get('50fps'),
+            groups=i.get('groups')
+        )
+
+    def parse_channel(self, i):
+        programs = []
+        for program in i.get('epg') or []:
+            images = program.get('images') or {}
+            programs.append(Asset(
+                'program',
+                title=program.get('title'),
+                description=program.get('description'),
+                landscape=self.get_image(images, 'landscape', self.thumb_width),
+                fanart=self.get_image(images, 'landscape', self.fanart_width),
+                broadcast_time=self.parse_timestamp(epg_date=program['epgLiveBroadcastTime'])
+            ))
+
+        # Keep the schedule so that now and next stay right while the listing is served from the cache
+        schedule = [(program.broadcast_time, [program.title, program.description, program.landscape, program.fanart])
+                    for program in programs]
+        self.epg.update(i['channel']['id'], schedule, time.time())
+
+        return Asset(
+            'channel',
+            id=i['channel']['id'],
+            title=i['channel']['title'],
+            landscape=self.get_image(i['channel'].get('images') or {}, 'landscape', self.thumb_width),
+            programs=programs
+        )
+
+    def get_now_next(self, channel_id, now):
+        """Return the programs on the channel at now and after it as Assets, None where the schedule has a gap."""
+        return tuple(self.make_program(entry) for entry in self.epg.now_next(channel_id, now))
+
+    def get_schedule(self, channel_id, start, end):
+        """Return the programs on the channel between start and end as Assets."""
+        return [self.make_program(entry) for entry in self.epg.window(channel_id, start, end)]
+
+    def make_program(self, entry):
+        if entry is None:
+            return None
+        start, program = entry
+        # Programs stored by earlier versions have no fanart
+        title, description, landscape, fanart = (list(program) + [None])[:4]
+        return Asset('program', title=title, description=description, landscape=landscape, fanart=fanart,
+                     broadcast_time=start)
+
+    def get_image(self, images, orientation, width):
+        """Return the URL of the smallest rendition of the image at least width pixels wide,
+        or of the largest one if none is."""
+        renditions = images.get(orientation)
+        if not renditions:
+            return None
+        widths = [rendition.get('width') or 0 for rendition in renditions]
+        wide_enough = [index for index in range(len(widths)) if widths[index] >= width]
+        if wide_enough:
+            index = min(wide_enough, key=widths.__getitem__)
+        else:
+            # Without widths this is the last rendition, the largest one in API responses
+            index = max(reversed(range(len(widths))), key=widths.__getitem__)
+        return renditions[index]['url']
+
+    def parse_timestamp(self, event_date=None, epg_date=None):
+        """Return an API date string as a UTC Unix timestamp.
+
+        Event times look like 2020-01-01T18:00:00Z and EPG times carry their UTC
+        offset like 2020-01-01T20:00:00+02:00, both are read by position.
+        """
+        date = event_date or epg_date
+        try:
+            timestamp = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                         int(date[11:13]), int(date[14:16]), int(date[17:19])))
+            offset = date[19:]
+            if offset and offset != 'Z':
+                if offset[0] not in '+-':
+                    raise ValueError(date)
+                seconds = int(offset[1:3]) * 3600 + int(offset[4:6] or 0) * 60
+                timestamp += seconds if offset[0] == '-' else -seconds
+            return timestamp
+        except (ValueError, IndexError):
+            # Anything else, for example fractional seconds, takes the slow path
+            return int(self.parse_datetime(date).timestamp())
+
+    def parse_datetime(self, date):
+        """Parse an ISO 8601 date string with a UTC offset to an aware datetime object."""
+        for date_time_format in ('%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f%z'):
+            try:
+                return datetime.strptime(date, date_time_format)
+            except ValueError:
+                pass
+        raise ValueError('Unknown date format: %s' % date)
+
+    def get_utc_offset(self, timestamp):
+        """Return the local UTC offset in seconds at timestamp, cached per hour."""
+        hour = int(timestamp // 3600)
+        offset = self.utc_offsets.get(hour)
+        if offset is None:
+            offset = time.localtime(timestamp).tm_gmtoff
+            self.utc_offsets[hour] = offset
+        return offset
+
+    def format_local_time(self, timestamp):
+        """Return a UTC Unix timestamp as a local time string."""
+        local = time.gmtime(timestamp + self.get_utc_offset(timestamp))
+        return '%02d.%02d.%d %02d:%02d' % (local.tm_mday, local.tm_mon, local.tm_year, local.tm_hour, local.tm_min)
+
+    def get_stream(self, video_id, refresh=False):
+        if not refresh:
+            stream = self.load_stream(video_id)
+            if stream:
+                self.log('Using resolved stream for %s' % video_id)
+                return stream
+
         stream = {}
         allowed_formats = ['ism', 'ismusp', 'mpd']
         url = self.config['vimondApiUrl'] + '/api/web/asset/{0}/play.json'.format(video_id)
         params = {'protocol': 'MPD'}
-        data_dict = json.loads(self.make_request(url, 'get', params=params, headers=None))['playback']
+        data_dict = self.make_request(url, 'get', params=params, headers=None)['playback']
 
         stream['drm_protected'] = data_dict['drmProtected']
 
@@ -213,33 +1063,51 @@ class CMore(object):
                 stream['license_url'] = data_dict['items']['item']['license']['@uri']
                 stream['drm_type'] = data_dict['items']['item']['license']['@name']
 
+        self.store_stream(video_id, stream)
         return stream
 
-    def parse_datetime(self, event_date=None, epg_date=None):
-        """Parse date string to datetime object."""
-        if event_date:
-            date_time_format = '%Y-%m-%dT%H:%M:%SZ'
-            datetime_obj = datetime(*(time.strptime(event_date, date_time_format)[0:6]))
-        else:
-            date_time_format = '%Y-%m-%dT%H:%M:%S'
-            date = epg_date.split('+')
-            datetime_obj = datetime(*(time.strptime(date[0], date_time_format)[0:6]))
-        return datetime_obj
-
-    def get_current_time(self, utc=None):
-        """Return the current local time."""
-        if utc:
-            return datetime.utcnow()
-        else:
-            return datetime.now()
-
-    # Sport live streams start time is in UTC, we need to convert it to localtime
-    def utc_to_local(self, utc_dt):
-        # get integer timestamp to avoid precision lost
-        timestamp = calendar.timegm(utc_dt.timetuple())
-        local_dt = datetime.fromtimestamp(timestamp)
-        assert utc_dt.resolution >= timedelta(microseconds=1)
-        return local_dt.replace(microsecond=utc_dt.microsecond)
-
-    def aslocaltimestr(self, utc_dt):
-        return self.utc_to_local(self.parse_datetime(event_date=utc_dt)).strftime('%d.%m.%Y %H:%M')
\ No newline at end of file
+    def stream_path(self, video_id):
+        return os.path.join(self.stream_dir, '%s.json' % os.path.basename(str(video_id)))
+
+    def load_stream(self, video_id):
+        """Return the resolved stream of video_id if it has not expired yet."""
+        try:
+            with open(self.stream_path(video_id)) as fh_stream:
+                entry = json.load(fh_stream)
+        except (IOError, ValueError):
+            return None
+        if entry['expires'] <= time.time():
+            return None
+        return entry['stream']
+
+    def store_stream(self, video_id, stream):
+        expires = time.time() + self.STREAM_CACHE_TTL
+        url_expiry = self.get_stream_expiry(stream.get('mpd_url'))
+        if url_expiry:
+            expires = min(expires, url_expiry - self.STREAM_EXPIRY_MARGIN)
+        if expires <= time.time():
+            return
+
+        os.makedirs(self.stream_dir, exist_ok=True)
+        entry = {'expires': expires, 'stream': stream}
+        write_atomic(self.stream_path(video_id), json.dumps(entry).encode('utf-8'))
+        self.streams_stored = True
+
+    def get_stream_expiry(self, url):
+        """Return the expiry timestamp of a signed stream URL, None if the URL has none."""
+        if not url:
+            return None
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        tokens = []
+        for key in ('exp', 'expires', 'Expires'):
+            tokens.extend(query.get(key, []))
+        # Akamai tokens look like hdnts=st=1600000000~exp=1600003600~acl=...~hmac=...
+        for key in ('hdnts', 'hdnea'):
+            for token in query.get(key, []):
+                tokens.extend(part[len('exp='):] for part in token.split('~') if part.startswith('exp='))
+        for token in tokens:
+            try:
+                return int(token)
+            except ValueError:
+                pass
+        return None
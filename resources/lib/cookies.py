@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Cookie jar for the CMore session
+"""
+import os
+import http.cookiejar
+
+class SessionCookieJar(http.cookiejar.LWPCookieJar):
+    """LWPCookieJar that remembers whether its cookies changed since they were loaded or saved."""
+    def __init__(self, filename=None):
+        super(SessionCookieJar, self).__init__(filename)
+        self.dirty = False
+
+    def set_cookie(self, cookie):
+        current = self._cookies.get(cookie.domain, {}).get(cookie.path, {}).get(cookie.name)
+        if current is None or current.value != cookie.value or current.expires != cookie.expires:
+            self.dirty = True
+        super(SessionCookieJar, self).set_cookie(cookie)
+
+    def clear(self, domain=None, path=None, name=None):
+        super(SessionCookieJar, self).clear(domain, path, name)
+        self.dirty = True
+
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        super(SessionCookieJar, self).load(filename, ignore_discard, ignore_expires)
+        self.dirty = False
+
+    def save_atomic(self):
+        """Save to a temporary file and move it over the cookie file so other processes never read a partial file."""
+        tmp_path = '%s.%s.tmp' % (self.filename, os.getpid())
+        self.save(tmp_path, ignore_discard=True, ignore_expires=False)
+        os.replace(tmp_path, self.filename)
+        self.dirty = False
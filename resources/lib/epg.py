@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Program schedules per channel for CMore, stored in the profile folder
+"""
+import json
+import bisect
+from array import array
+
+from .cache import write_atomic
+
+
+class EpgStore(object):
+    """Schedules as sorted arrays of start times with the programs in a parallel list.
+
+    A program runs until the next one starts. Programs are opaque JSON
+    serializable values to the store.
+    """
+    # The last known program is not assumed to run longer than this
+    MAX_PROGRAM_LENGTH = 6 * 3600
+
+    def __init__(self, path, keep_past=6 * 3600):
+        self.path = path
+        self.keep_past = keep_past
+        self.channels = None
+        self.dirty = False
+
+    def load(self):
+        if self.channels is not None:
+            return
+        self.channels = {}
+        try:
+            with open(self.path) as fh_epg:
+                data = json.load(fh_epg)
+        except (IOError, ValueError):
+            return
+        for channel_id, (starts, programs) in data.items():
+            self.channels[channel_id] = (array('q', starts), programs)
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = dict((channel_id, (starts.tolist(), programs)) for channel_id, (starts, programs) in self.channels.items())
+        write_atomic(self.path, json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        self.dirty = False
+
+    def update(self, channel_id, schedule, now):
+        """Merge a schedule of (start, program) tuples for the window from its first to its last start.
+
+        Stored programs in that window are replaced, the ones around it are kept
+        and programs that ended keep_past seconds before now are dropped.
+        """
+        self.load()
+        # JSON object keys are strings, the API may give integer ids
+        channel_id = str(channel_id)
+        schedule = sorted(schedule, key=lambda entry: entry[0])
+        if not schedule:
+            return
+        starts, programs = self.channels.get(channel_id, (array('q'), []))
+        window_start = bisect.bisect_left(starts, schedule[0][0])
+        window_end = bisect.bisect_right(starts, schedule[-1][0])
+        new_starts = array('q', (entry[0] for entry in schedule))
+        new_programs = [entry[1] for entry in schedule]
+        if starts[window_start:window_end] == new_starts and programs[window_start:window_end] == new_programs:
+            return
+
+        starts = starts[:window_start] + new_starts + starts[window_end:]
+        programs = programs[:window_start] + new_programs + programs[window_end:]
+        # Drop programs that ended long enough ago, a program ends when the next one starts
+        expired = max(0, bisect.bisect_right(starts, now - self.keep_past) - 1)
+        self.channels[channel_id] = (starts[expired:], programs[expired:])
+        self.dirty = True
+
+    def get_index(self, channel_id, timestamp):
+        """Return the schedule of the channel and the index of the program running at timestamp, -1 if none."""
+        self.load()
+        starts, programs = self.channels.get(str(channel_id), (array('q'), []))
+        return starts, programs, bisect.bisect_right(starts, timestamp) - 1
+
+    def at(self, channel_id, timestamp):
+        """Return the (start, program) running on the channel at timestamp or None."""
+        starts, programs, index = self.get_index(channel_id, timestamp)
+        # The last program has no known end, do not stretch it over a gap in the data
+        if index < 0 or index == len(starts) - 1 and timestamp - starts[index] > self.MAX_PROGRAM_LENGTH:
+            return None
+        return starts[index], programs[index]
+
+    def now_next(self, channel_id, now):
+        """Return the (start, program) tuples running at now and starting after it, None where unknown."""
+        starts, programs, index = self.get_index(channel_id, now)
+        current = self.at(channel_id, now)
+        upcoming = (starts[index + 1], programs[index + 1]) if index + 1 < len(starts) else None
+        return current, upcoming
+
+    def window(self, channel_id, start, end):
+        """Return the (start, program) tuples running between start and end, for guide views."""
+        starts, programs, first = self.get_index(channel_id, start)
+        last = bisect.bisect_left(starts, end)
+        return list(zip(starts[max(first, 0):last], programs[max(first, 0):last]))
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import time
 import urllib
 import re
+from types import MappingProxyType
 
 from .cmore import CMore
 
@@ -11,11 +14,94 @@ import xbmcvfs
 import xbmcgui
 import xbmcplugin
 from xbmcaddon import Addon
-import inputstreamhelper
+
+class Settings(object):
+    """Read-only snapshot of the add-on settings, loaded once per plugin run."""
+    __slots__ = ('_values',)
+    SETTING_IDS = ('username', 'password', 'sub_lang', '50fps', 'prefetch_seasons', 'prefetch_streams',
+                   'warm_cache', 'performance_trace', 'cache_size', 'thumb_width', 'fanart_width')
+
+    def __init__(self, addon):
+        values = {}
+        for setting_id in self.SETTING_IDS:
+            values[setting_id] = addon.getSetting(setting_id)
+        self._values = MappingProxyType(values)
+
+    def get(self, setting_id):
+        setting = self._values[setting_id]
+        if setting == 'true':
+            return True
+        elif setting == 'false':
+            return False
+        else:
+            return setting
+
+    @property
+    def username(self):
+        return self._values['username']
+
+    @property
+    def password(self):
+        return self._values['password']
+
+    @property
+    def sub_lang(self):
+        return 'sv' if self._values['sub_lang'] == '1' else 'fi'
+
+    @property
+    def use_50fps(self):
+        return self._values['50fps'] == 'true'
+
+    @property
+    def prefetch_seasons(self):
+        return self._values['prefetch_seasons'] == 'true'
+
+    @property
+    def prefetch_streams(self):
+        """Number of playable items per listing to resolve in advance."""
+        try:
+            return int(self._values['prefetch_streams'])
+        except ValueError:
+            return 0
+
+    @property
+    def warm_cache(self):
+        return self._values['warm_cache'] != 'false'
+
+    @property
+    def cache_size(self):
+        """Byte budget of the response cache."""
+        try:
+            return int(self._values['cache_size']) * 1024 * 1024
+        except ValueError:
+            return 32 * 1024 * 1024
+
+    @property
+    def thumb_width(self):
+        """Target width in pixels of thumbnail and poster images."""
+        try:
+            return int(self._values['thumb_width'])
+        except ValueError:
+            return 480
+
+    @property
+    def fanart_width(self):
+        """Target width in pixels of fanart images."""
+        try:
+            return int(self._values['fanart_width'])
+        except ValueError:
+            return 1280
+
+    @property
+    def performance_trace(self):
+        return self._values['performance_trace'] == 'true'
+
 
 class KodiHelper(object):
     def __init__(self, base_url=None, handle=None):
         addon = self.get_addon()
+        self.addon = addon
+        self.settings = Settings(addon)
         self.base_url = base_url
         self.handle = handle
         self.addon_path = xbmcvfs.translatePath(addon.getAddonInfo('path'))
@@ -24,39 +110,50 @@ class KodiHelper(object):
         self.addon_version = addon.getAddonInfo('version')
         self.language = addon.getLocalizedString
         self.logging_prefix = '[%s-%s]' % (self.addon_name, self.addon_version)
+        # Fallback art for items without their own, looked up once per run
+        self.default_art = {
+            'icon': addon.getAddonInfo('icon'),
+            'fanart': addon.getAddonInfo('fanart')
+        }
+        # Directory items collected by add_item and emitted in one batch by eod
+        self.listing = []
+        self.content = None
+        self.listing_started = None
+        # Video ids of the playable items added during this run
+        self.playable_ids = []
         if not xbmcvfs.exists(self.addon_profile):
             xbmcvfs.mkdir(self.addon_profile)
-        self.c = CMore(self.addon_profile, True)
+        self.c = CMore(self.addon_profile, True, trace=self.settings.performance_trace,
+                       cache_size=self.settings.cache_size, thumb_width=self.settings.thumb_width,
+                       fanart_width=self.settings.fanart_width)
 
     def get_addon(self):
         """Returns a fresh addon instance."""
         return Addon()
 
     def get_setting(self, setting_id):
-        addon = self.get_addon()
-        setting = addon.getSetting(setting_id)
-        if setting == 'true':
-            return True
-        elif setting == 'false':
-            return False
-        else:
-            return setting
+        return self.settings.get(setting_id)
 
     def set_setting(self, key, value):
-        return self.get_addon().setSetting(key, value)
+        result = self.addon.setSetting(key, value)
+        self.refresh_settings()
+        return result
+
+    def refresh_settings(self):
+        """Reload the settings snapshot after the settings have been changed."""
+        self.addon = self.get_addon()
+        self.settings = Settings(self.addon)
+
+    def open_settings(self):
+        self.addon.openSettings()
+        self.refresh_settings()
 
     def log(self, string):
         msg = '%s: %s' % (self.logging_prefix, string)
         xbmc.log(msg=msg, level=xbmc.LOGDEBUG)
 
     def get_sub_lang(self):
-        sub_lang_id = self.get_setting('sub_lang')
-        if sub_lang_id == '0':
-            sub_lang = 'fi'
-        elif sub_lang_id == '1':
-            sub_lang = 'sv'
-
-        return sub_lang
+        return self.settings.sub_lang
 
     def dialog(self, dialog_type, heading, message=None, options=None, nolabel=None, yeslabel=None):
         dialog = xbmcgui.Dialog()
@@ -92,56 +189,110 @@ class KodiHelper(object):
             return False
 
     def set_login_credentials(self):
-        username = self.get_setting('username')
-        password = self.get_setting('password')
+        username = self.settings.username
+        password = self.settings.password
 
         if not username or not password:
                 self.dialog('ok', self.language(30003), self.language(30004))
-                self.get_addon().openSettings()
+                self.open_settings()
         else:
+            self.c.set_credentials(username, password)
             return True
 
     def login_process(self):
-        username = self.get_setting('username')
-        password = self.get_setting('password')
-        self.c.login(username, password)
+        """Log in unless the stored session cookies are still valid."""
+        self.c.set_credentials(self.settings.username, self.settings.password)
+        self.c.ensure_login()
 
     def reset_credentials(self):
         self.set_setting('username', '')
         self.set_setting('password', '')
 
     def add_item(self, title, params, items=False, folder=True, playable=False, info=None, art=None, content=False):
-        addon = self.get_addon()
-        listitem = xbmcgui.ListItem(label=title)
+        # offscreen items skip the GUI lock, they are only handed over to Kodi in eod
+        listitem = xbmcgui.ListItem(label=title, offscreen=True)
 
         if playable:
+            if 'video_id' in params:
+                self.playable_ids.append(params['video_id'])
             listitem.setProperty('IsPlayable', 'true')
             #listitem.setProperty("StartPercent", '50.0')
             folder = False
         if art:
             listitem.setArt(art)
         else:
-            art = {
-                'icon': addon.getAddonInfo('icon'),
-                'fanart': addon.getAddonInfo('fanart')
-            }
-            listitem.setArt(art)
+            listitem.setArt(self.default_art)
         if info:
             listitem.setInfo('video', info)
         if content:
-            xbmcplugin.setContent(self.handle, content)
+            self.content = content
 
         recursive_url = self.base_url + '?' + urllib.parse.urlencode(params)
 
+        if self.listing_started is None:
+            self.listing_started = time.perf_counter()
+
         if items is False:
-            xbmcplugin.addDirectoryItem(self.handle, recursive_url, listitem, folder)
+            self.listing.append((recursive_url, listitem, folder))
         else:
             items.append((recursive_url, listitem, folder))
             return items
 
-    def eod(self):
-        """Tell Kodi that the end of the directory listing is reached."""
-        xbmcplugin.endOfDirectory(self.handle)
+    def eod(self, succeeded=True):
+        """Hand the collected items to Kodi and tell it that the end of the directory listing is reached."""
+        if self.content:
+            xbmcplugin.setContent(self.handle, self.content)
+        xbmcplugin.addSortMethod(self.handle, xbmcplugin.SORT_METHOD_UNSORTED)
+        xbmcplugin.addSortMethod(self.handle, xbmcplugin.SORT_METHOD_LABEL)
+        xbmcplugin.addDirectoryItems(self.handle, self.listing, len(self.listing))
+        xbmcplugin.endOfDirectory(self.handle, succeeded)
+        if self.listing_started is not None:
+            self.c.tracer.record('listing', self.content or 'files', items=len(self.listing),
+                                 ms=round((time.perf_counter() - self.listing_started) * 1000, 2))
+        self.listing = []
+        self.content = None
+        self.listing_started = None
+
+    def is_listing_shown(self):
+        """Return True if Kodi still shows the listing of this invocation, the user may have moved on
+        while it was revalidated or updated."""
+        return xbmc.getInfoLabel('Container.FolderPath') == self.base_url + sys.argv[2]
+
+    def revalidate_listing(self):
+        """Revalidate the responses the listing was built from stale and reload it if any of them changed."""
+        if self.c.stale_responses and self.c.revalidate_stale():
+            if not self.is_listing_shown():
+                self.log('Listing changed on revalidation but is no longer shown.')
+                return
+            self.log('Listing changed on revalidation, refreshing.')
+            xbmc.executebuiltin('Container.Refresh')
+
+    def update_listing(self, params):
+        """Replace the current listing with the plugin URL for params if it is still shown."""
+        if not self.is_listing_shown():
+            self.log('Listing is no longer shown, not updating it.')
+            return
+        xbmc.executebuiltin('Container.Update(%s,replace)' % (self.base_url + '?' + urllib.parse.urlencode(params)))
+
+    def record_route(self, route, start_time, import_time, init_time):
+        """Add the total time of this plugin invocation and its start-up share to the trace."""
+        self.c.tracer.record('route', route,
+                             ms=round((time.perf_counter() - start_time) * 1000, 2),
+                             import_ms=round((import_time - start_time) * 1000, 2),
+                             init_ms=round((init_time - import_time) * 1000, 2),
+                             requests_imported='requests' in sys.modules)
+
+    def show_perf_report(self):
+        report = self.c.tracer.report()
+        if not report:
+            report = self.language(30020)
+        xbmcgui.Dialog().textviewer(self.language(30019), report)
+
+    def prefetch_streams(self):
+        """Resolve the streams of the first playable items of the listing when enabled in settings."""
+        count = self.settings.prefetch_streams
+        if count and self.playable_ids:
+            self.c.prefetch_streams(self.playable_ids[:count])
 
     def play_item(self, video_id):
         try:
@@ -152,6 +303,8 @@ class KodiHelper(object):
             playitem.setProperty('inputstream.adaptive.manifest_type', 'mpd')
 
             if stream['drm_protected']:
+                # Only the play route needs inputstreamhelper, keep it out of the listing start-up
+                import inputstreamhelper
                 is_helper = inputstreamhelper.Helper('mpd', drm='com.widevine.alpha')
                 if is_helper.check_inputstream():
                     playitem.setProperty('inputstream.adaptive.license_type', 'com.widevine.alpha')
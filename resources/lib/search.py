@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Local search over the assets CMore has listed, stored in the profile folder
+"""
+import os
+import re
+import json
+import zlib
+import hashlib
+import unicodedata
+
+from .cache import write_atomic
+
+COMBINING_RE = re.compile('[\u0300-\u036f]')
+TOKEN_RE = re.compile(r'\w\w+')
+
+
+def fold(text):
+    """Return text in lower case without accents, so that aiti matches äiti and Åland matches aland."""
+    return COMBINING_RE.sub('', unicodedata.normalize('NFKD', text.lower()))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(fold(text))
+
+
+class SearchIndex(object):
+    """Inverted index from folded words to assets.
+
+    Listings only append their assets to a pending batch file, which is cheap.
+    The batches are merged into the index, a zlib compressed JSON file, when
+    the index is searched and by the periodic cache maintenance.
+    """
+    INDEXED_KINDS = ('movie', 'episode', 'tvshow', 'season')
+    MAX_DOCS = 5000
+    MAX_RESULTS = 100
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.index_path = os.path.join(index_dir, 'index.z')
+        self.pending_dir = os.path.join(index_dir, 'pending')
+        self.docs = None
+        self.keys = None
+        self.postings = None
+        self.dirty = False
+
+    def add_pending(self, assets):
+        """Queue the indexable assets of a listing for the next merge."""
+        batch = [asset.to_list() for asset in assets if asset.kind in self.INDEXED_KINDS]
+        if not batch:
+            return
+        data = json.dumps(batch, separators=(',', ':')).encode('utf-8')
+        # The same listing opened again gives the same batch, which is only stored once
+        path = os.path.join(self.pending_dir, hashlib.sha1(data).hexdigest()[:20] + '.z')
+        if not os.path.exists(path):
+            os.makedirs(self.pending_dir, exist_ok=True)
+            write_atomic(path, zlib.compress(data))
+
+    def load(self):
+        if self.docs is not None:
+            return
+        try:
+            with open(self.index_path, 'rb') as fh_index:
+                index = json.loads(zlib.decompress(fh_index.read()))
+            self.docs = index['docs']
+            self.postings = index['postings']
+        except (IOError, ValueError, KeyError, zlib.error):
+            self.docs = []
+            self.postings = {}
+        self.keys = {}
+        for number, doc in enumerate(self.docs):
+            if doc:
+                self.keys['%s:%s' % (doc[0], doc[1])] = number
+
+    def save(self):
+        if not self.dirty:
+            return
+        index = {'docs': self.docs, 'postings': self.postings}
+        os.makedirs(self.index_dir, exist_ok=True)
+        write_atomic(self.index_path, zlib.compress(json.dumps(index, separators=(',', ':')).encode('utf-8')))
+        self.dirty = False
+
+    def merge_pending(self):
+        """Add the queued batches to the index and save it."""
+        # Start from the saved index, another process may have merged batches since it was loaded
+        self.docs = None
+        self.load()
+        try:
+            names = os.listdir(self.pending_dir)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.pending_dir, name)
+            try:
+                with open(path, 'rb') as fh_batch:
+                    batch = json.loads(zlib.decompress(fh_batch.read()))
+            except (IOError, ValueError, zlib.error):
+                batch = []
+            for doc in batch:
+                self.add(doc)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if len(self.docs) > self.MAX_DOCS * 3 // 2:
+            self.compact()
+        self.save()
+
+    def add(self, doc):
+        """Add or update an asset given in the Asset.to_list form."""
+        key = '%s:%s' % (doc[0], doc[1])
+        number = self.keys.get(key)
+        if number is not None:
+            if self.docs[number] == doc:
+                return
+            # Postings of the old version are dropped on compaction
+            self.docs[number] = None
+
+        number = len(self.docs)
+        self.docs.append(doc)
+        self.keys[key] = number
+        for token in set(tokenize(self.get_text(doc))):
+            self.postings.setdefault(token, []).append(number)
+        self.dirty = True
+
+    def get_text(self, doc):
+        fields = dict(zip(('kind', 'id', 'title', 'subtitle', 'description', 'cast', 'director', 'genre'), doc))
+        parts = [fields['title'], fields['subtitle'], fields['description'], fields['director'], fields['genre']]
+        parts.extend(fields['cast'] or [])
+        return ' '.join(str(part) for part in parts if part)
+
+    def compact(self):
+        """Drop replaced assets and keep the MAX_DOCS most recently added ones."""
+        live = [number for number, doc in enumerate(self.docs) if doc][-self.MAX_DOCS:]
+        renumber = dict((old, new) for new, old in enumerate(live))
+        self.docs = [self.docs[number] for number in live]
+        postings = {}
+        for token, numbers in self.postings.items():
+            numbers = [renumber[number] for number in numbers if number in renumber]
+            if numbers:
+                postings[token] = numbers
+        self.postings = postings
+        self.keys = dict(('%s:%s' % (doc[0], doc[1]), number) for number, doc in enumerate(self.docs))
+        self.dirty = True
+
+    def search(self, query):
+        """Return the docs matching all words of query, the last word as a prefix, titles first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        self.merge_pending()
+
+        matches = None
+        for position, token in enumerate(tokens):
+            if position == len(tokens) - 1:
+                numbers = set()
+                for word, postings in self.postings.items():
+                    if word.startswith(token):
+                        numbers.update(postings)
+            else:
+                numbers = set(self.postings.get(token, []))
+            matches = numbers if matches is None else matches & numbers
+            if not matches:
+                return []
+
+        def rank(number):
+            title = fold(str(self.docs[number][2] or ''))
+            return (not all(token in title for token in tokens), -number)
+
+        results = sorted((number for number in matches if self.docs[number]), key=rank)
+        return [self.docs[number] for number in results[:self.MAX_RESULTS]]
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Performance trace for CMore, written as JSON lines to the profile folder
+"""
+import os
+import re
+import json
+import time
+import threading
+import urllib.parse
+
+ID_SEGMENT_RE = re.compile(r'/\d+(?=/|$)')
+
+
+def get_endpoint(url):
+    """Return the path of url with numeric ids replaced, for grouping requests per endpoint."""
+    return ID_SEGMENT_RE.sub('/{id}', urllib.parse.urlparse(url).path)
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    index = max(0, min(len(values) - 1, int(round(percent / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+class Tracer(object):
+    def __init__(self, path, enabled=False, max_size=512 * 1024):
+        self.path = path
+        self.enabled = enabled
+        self.max_size = max_size
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, **fields):
+        """Buffer an event, fields are numbers in milliseconds and bytes or short strings."""
+        if not self.enabled:
+            return
+        fields = dict((key, value) for key, value in fields.items() if value is not None)
+        fields['kind'] = kind
+        fields['name'] = name
+        fields['time'] = int(time.time())
+        with self.lock:
+            self.events.append(fields)
+
+    def flush(self):
+        """Append the buffered events to the trace file, keeping one rotated file around."""
+        with self.lock:
+            events, self.events = self.events, []
+        if not events:
+            return
+        try:
+            if os.path.getsize(self.path) > self.max_size:
+                os.replace(self.path, self.path + '.1')
+        except OSError:
+            pass
+        with open(self.path, 'a') as fh_trace:
+            fh_trace.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events))
+
+    def load(self):
+        """Return the events of the rotated and the current trace file, oldest first."""
+        events = []
+        for path in (self.path + '.1', self.path):
+            try:
+                with open(path) as fh_trace:
+                    for line in fh_trace:
+                        try:
+                            events.append(json.loads(line))
+                        except ValueError:
+                            pass
+            except IOError:
+                pass
+        return events
+
+    def report(self, events=None):
+        """Return a plain text summary of the trace with latency percentiles per route, listing and endpoint."""
+        if events is None:
+            events = self.load()
+        groups = {}
+        for event in events:
+            if 'ms' in event:
+                groups.setdefault((event['kind'], event['name']), []).append(event)
+
+        lines = []
+        for kind in ('route', 'listing', 'request'):
+            names = sorted(name for group_kind, name in groups if group_kind == kind)
+            if not names:
+                continue
+            lines.append('[B]%s[/B]' % kind)
+            for name in names:
+                group = groups[(kind, name)]
+                timings = sorted(event['ms'] for event in group)
+                line = '%s: n=%d p50=%.0fms p90=%.0fms p99=%.0fms max=%.0fms' % (
+                    name, len(timings), percentile(timings, 50), percentile(timings, 90),
+                    percentile(timings, 99), timings[-1])
+                if kind == 'request':
+                    cached = [event['cache'] for event in group if 'cache' in event]
+                    sizes = [event['bytes'] for event in group if event.get('bytes')]
+                    decode = sorted(event['decode_ms'] for event in group if 'decode_ms' in event)
+                    errors = sum(1 for event in group if event.get('error'))
+                    if cached:
+                        line += ' hits=%d%%' % (cached.count('hit') * 100 / len(cached))
+                    if sizes:
+                        line += ' avg=%.1fKiB' % (sum(sizes) / len(sizes) / 1024.0)
+                    if decode:
+                        line += ' decode p90=%.1fms' % percentile(decode, 90)
+                    if errors:
+                        line += ' errors=%d' % errors
+                elif kind == 'route':
+                    startup = sorted(event.get('import_ms', 0) + event.get('init_ms', 0) for event in group)
+                    line += ' start-up p50=%.0fms' % percentile(startup, 50)
+                elif kind == 'listing':
+                    line += ' items p50=%d' % percentile(sorted(event.get('items', 0) for event in group), 50)
+                lines.append(line)
+            lines.append('')
+        return '\n'.join(lines)
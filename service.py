@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Background service that keeps the C More catalog cache warm
+"""
+import xbmc
+
+from resources.lib.kodihelper import KodiHelper
+
+# All intervals in seconds
+STARTUP_DELAY = 60
+WARM_UP_INTERVAL = 15 * 60
+REQUEST_INTERVAL = 2
+MAX_REQUEST_INTERVAL = 10 * 60
+PLAYBACK_POLL_INTERVAL = 30
+
+
+class CacheWarmer(object):
+    def __init__(self):
+        self.monitor = xbmc.Monitor()
+        self.player = xbmc.Player()
+        self.helper = KodiHelper()
+        self.request_interval = REQUEST_INTERVAL
+
+    def wait(self, seconds):
+        """Wait for seconds. Return True if Kodi is shutting down."""
+        return self.monitor.waitForAbort(seconds)
+
+    def pace(self):
+        """Wait before the next request, for as long as a video is playing. Return True if Kodi is shutting down."""
+        while self.player.isPlaying():
+            if self.wait(PLAYBACK_POLL_INTERVAL):
+                return True
+        return self.wait(self.request_interval)
+
+    def fetch(self, function, *args, **kwargs):
+        """Call function when it is our turn. Return its result, or None if it failed or Kodi is shutting down."""
+        if self.pace():
+            return None
+        try:
+            result = function(*args, **kwargs)
+        except (IOError, ValueError, KeyError, self.helper.c.CMoreError) as error:
+            # Back off in case the API is rate limiting us
+            self.request_interval = min(self.request_interval * 2, MAX_REQUEST_INTERVAL)
+            self.helper.log('Cache warm-up request failed: %s' % error)
+            return None
+        self.request_interval = REQUEST_INTERVAL
+        return result
+
+    def warm_up(self):
+        c = self.helper.c
+        tree = self.fetch(c.get_page, page_type='/tree', refresh=True)
+        if tree is None:
+            # The config may not have been downloaded either, try again next cycle
+            c.close()
+            return
+        self.fetch(c.get_paths_index, refresh=True)
+        self.fetch(c.get_page, dataurl=c.config['dynamicMbApiUrl'] + '/favorites', refresh=True)
+        for path in c.get_section_paths(tree):
+            if self.monitor.abortRequested():
+                break
+            self.fetch(c.refresh_section, path)
+        c.close()
+
+    def maintain(self):
+        c = self.helper.c
+        c.cache.max_size = self.helper.settings.cache_size
+        try:
+            c.maintain_cache()
+        except (IOError, OSError) as error:
+            self.helper.log('Cache maintenance failed: %s' % error)
+
+    def run(self):
+        if self.wait(STARTUP_DELAY):
+            return
+        while not self.monitor.abortRequested():
+            self.helper.refresh_settings()
+            settings = self.helper.settings
+            if settings.warm_cache and settings.username and settings.password:
+                self.helper.c.set_credentials(settings.username, settings.password)
+                self.helper.log('Warming up the catalog cache.')
+                self.warm_up()
+            self.maintain()
+            if self.wait(WARM_UP_INTERVAL):
+                break
+
+
+if __name__ == '__main__':
+    CacheWarmer().run()